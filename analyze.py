@@ -21,12 +21,15 @@
 # THE SOFTWARE.
 #
 
+import json
 import logging
 import os
 import re
 import subprocess
 import sys
 
+import setupini
+
 
 class PackageKind:
     def __init__(self, kind=None, script='', depends=None, arches=None, tokens=None, announce=''):
@@ -125,48 +128,49 @@ def get_var(var, default=None):
     return var_values.get(var)
 
 
-def parse_cygport(fn):
+def parse_cygport(fn, content=None):
     logging.info('parsing cygport %s' % fn)
 
-    with open(fn) as f:
-        content = f.read()
-
-        # discard comments
-        content = re.sub(r'#.*$', '', content, flags=re.MULTILINE)
-
-        # fold any line-continuations
-        content = re.sub(r'\\\n', '', content)
-
-        # Does it have a line that sets or adds to the value of a variable of
-        # interest? (Note that this only approximates the value.  The only
-        # accurate way to evaluate it is to execute the cygport).
-        for var in var_list + ['ARCH']:
-            value = ''
-            matches = re.finditer(r'^\s*' + var + r'(?:\+|)=\s*("?)(.*?)\1\s*$', content, re.MULTILINE | re.DOTALL)
-            for match in matches:
-                if value:
-                    value += ' '
-                value += match.group(2)
-            if value:
-                var_values[var] = value
+    if content is None:
+        with open(fn) as f:
+            content = f.read()
 
-        # Work out what ARCHES should have been
-        if 'ARCH' in var_values:
-            var_values['ARCHES'] = var_values.pop('ARCH')
-        else:
-            var_values['ARCHES'] = 'all'
+    # discard comments
+    content = re.sub(r'#.*$', '', content, flags=re.MULTILINE)
+
+    # fold any line-continuations
+    content = re.sub(r'\\\n', '', content)
 
-        # Also look for inherits lines, to work out what INHERITED should have
-        # been
-        inherits = ''
-        for l in content.splitlines():
-            match = re.match('^inherit(.*)', l)
-            if match:
-                inherits += match.group(1) + ' '
-        var_values['INHERITED'] = inherits
+    # Does it have a line that sets or adds to the value of a variable of
+    # interest? (Note that this only approximates the value.  The only
+    # accurate way to evaluate it is to execute the cygport).
+    for var in var_list + ['ARCH']:
+        value = ''
+        matches = re.finditer(r'^\s*(?:export\s+|)' + var + r'(?:\+|)=\s*("?)(.*?)\1\s*$', content, re.MULTILINE | re.DOTALL)
+        for match in matches:
+            if value:
+                value += ' '
+            value += match.group(2)
+        if value:
+            var_values[var] = value
+
+    # Work out what ARCHES should have been
+    if 'ARCH' in var_values:
+        var_values['ARCHES'] = var_values.pop('ARCH')
+    else:
+        var_values['ARCHES'] = 'all'
+
+    # Also look for inherits lines, to work out what INHERITED should have
+    # been
+    inherits = ''
+    for l in content.splitlines():
+        match = re.match('^inherit(.*)', l)
+        if match:
+            inherits += match.group(1) + ' '
+    var_values['INHERITED'] = inherits
 
-        for var in var_values:
-            logging.info('%s="%s"' % (var, var_values[var]))
+    for var in var_values:
+        logging.info('%s="%s"' % (var, var_values[var]))
 
 
 #
@@ -174,7 +178,30 @@ def parse_cygport(fn):
 #
 
 def analyze(repodir, default_tokens):
-    files = os.listdir(repodir)
+    def read(fn):
+        with open(os.path.join(repodir, fn), 'rb') as f:
+            return f.read()
+
+    return _analyze(os.listdir(repodir), read, default_tokens)
+
+
+# analyze the tree of commit in the git repository gitdir, without checking it
+# out (e.g. a bare repository, in post-receive).  The cygport isn't evaluated,
+# only parsed, so this only approximates what analyze() would find.
+def analyze_commit(gitdir, commit, default_tokens):
+    def git(*args):
+        return subprocess.run(['git', '-C', gitdir] + list(args), check=True, capture_output=True).stdout
+
+    def read(fn):
+        return git('show', '%s:%s' % (commit, fn))
+
+    files = git('ls-tree', '--name-only', commit).decode().splitlines()
+    return _analyze(files, read, default_tokens, static=True)
+
+
+def _analyze(files, read, default_tokens, static=False):
+    var_values.clear()
+
     cygports = [m for m in files if re.search(r'\.cygport$', m)]
 
     # more than one cygport!
@@ -187,9 +214,9 @@ def analyze(repodir, default_tokens):
         fn = cygports[0]
         logging.info('source contains cygport %s' % fn)
 
-        if not cygport_vars(fn):
+        if static or not cygport_vars(fn):
             # fallback to trying to parse the cygport (as previously)
-            parse_cygport(os.path.join(repodir, fn))
+            parse_cygport(fn, read(fn).decode(errors='replace'))
 
         # does it have a BUILD_REQUIRES or DEPEND line?
         depends = get_var('BUILD_REQUIRES', '') + ' ' + get_var('DEPEND', '')
@@ -197,14 +224,14 @@ def analyze(repodir, default_tokens):
         logging.info('build dependencies (from BUILD_REQUIRES): %s' % (','.join(sorted(depends))))
 
         # extract any SCALLYWAG line
-        tokens = default_tokens
+        tokens = list(default_tokens)
         scallywag = get_var('SCALLYWAG', '')
         if scallywag:
             tokens.extend(scallywag.split())
             logging.info('cygport SCALLYWAG: %s' % tokens)
 
         if 'upload' in get_var('RESTRICT', ''):
-            tokens.add('nodeploy')
+            tokens.append('nodeploy')
             logging.info("cygport RESTRICT contains 'upload', adding 'nodeploy'")
 
         # detect if there is an ARCH line
@@ -220,20 +247,28 @@ def analyze(repodir, default_tokens):
 
         # for cross-packages, we need the appropriate cross-toolchain
         if 'cross' in inherited:
-            cross_host = get_var('CROSS_HOST')
+            cross_host = get_var('CROSS_HOST', '' if static else None)
             pkg_prefix = cross_package_prefixes.get(cross_host, '')
-            if not pkg_prefix:
+            if pkg_prefix:
+                logging.info('cross_host: %s, pkg_prefix: %s' % (cross_host, pkg_prefix))
+
+                for tool in ['binutils', 'gcc-core', 'gcc-g++', 'pkg-config']:
+                    depends.add('%s%s' % (pkg_prefix, tool))
+            elif static:
+                # (parsing the cygport only approximates the value, which may
+                # be missing, computed, or set differently in different
+                # branches, so leave it to the build to decide)
+                logging.warning('cross_host: %s, not known until the cygport is evaluated' % (cross_host or 'unset'))
+            else:
                 logging.error('cross_host: %s, pkg_prefix is unknown' % (cross_host))
                 return PackageKind()
-            logging.info('cross_host: %s, pkg_prefix: %s' % (cross_host, pkg_prefix))
-
-            for tool in ['binutils', 'gcc-core', 'gcc-g++', 'pkg-config']:
-                depends.add('%s%s' % (pkg_prefix, tool))
 
         depends.update(depends_from_inherits(inherited, tokens))
 
         generalize_python_depends(depends, tokens)
 
+        depends = check_depends(depends, tokens)
+
         announce = get_var('ANNOUNCE', '')
 
         logging.info('build dependencies (complete): %s' % (','.join(sorted(depends))))
@@ -244,10 +279,9 @@ def analyze(repodir, default_tokens):
     scripts = [m for m in files if re.search(r'\.sh$', m)]
     if len(scripts) == 1:
         fn = scripts[0]
-        f = open(os.path.join(repodir, fn), 'rb')
         # analyze it's content to classify as cygbuild or g-b-s
         # (some copies of cygbuild contain a latin1 encoded 'í' i-acute)
-        content = f.read().decode(errors='replace')
+        content = read(fn).decode(errors='replace')
         if re.search('^CYGBUILD', content, re.MULTILINE):
             kind = 'cygbuild'
         else:
@@ -377,6 +411,44 @@ def generalize_python_depends(depends, tokens):
             depends.update(gen_atom)
 
 
+#
+# check the build dependencies against the index of setup.ini, if there is one
+# (see setupini.py), replacing obsolete package names, and dropping those which
+# are installed anyway as a requirement of another
+#
+
+def check_depends(depends, tokens):
+    conn = setupini.connect()
+    if not conn:
+        return depends
+
+    names, unknown = setupini.validate(conn, depends)
+    if unknown:
+        logging.error('unknown build dependencies: %s' % (','.join(sorted(unknown))))
+
+    # (the index is of the current versions, which test versions may not
+    # require the same things as)
+    if 'testpackages' not in tokens:
+        names = setupini.minimal(conn, names - unknown) | unknown
+        logging.info('build dependencies (minimal): %s' % (','.join(sorted(names))))
+
+    conn.close()
+    return names
+
+
+#
+# record the arches to build, and if building is disabled, as outputs of the
+# GitHub Actions step (appended to the file named by GITHUB_OUTPUT), so the
+# workflow can skip the jobs for other arches without starting a runner for
+# them (see .github/workflows/scallywag.yml)
+#
+
+def write_outputs(fn, package):
+    with open(fn, 'a') as f:
+        print('arches=%s' % json.dumps(package.arches), file=f)
+        print('nobuild=%s' % ('true' if 'nobuild' in package.tokens else 'false'), file=f)
+
+
 #
 # analyse the specified directory
 #
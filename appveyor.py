@@ -11,6 +11,7 @@ class Backend():
     @staticmethod
     def cancel_build(bbid):
         print('job cancellation not implemented for AppVeyor backend')
+        return False
 
     @staticmethod
     def request_build(package, maintainer, commit, reference, default_tokens, buildnumber):
@@ -22,6 +23,10 @@ class Backend():
     def check_build_status(bbid):
         return _appveyor_check_status(bbid)
 
+    @staticmethod
+    def throttle():
+        return True
+
 
 def _appveyor_build_request(package, maintainer, commit, reference, default_tokens, buildnumber):
     slug = 'scallywag'
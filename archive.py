@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+#
+# move old jobs in terminal states from carpetbag.db to the archive database
+#
+# This keeps the jobs table which jobs.cgi, the CLI and the daemon query
+# small.  Archived jobs are still visible to jobs.cgi and the jobs CLI, which
+# attach the archive when asked for old ids or dates (see
+# carpetbag.attach_archive()).
+#
+# Jobs are moved in small batches, each in a short transaction, pausing
+# between them so the webhook and daemon aren't kept waiting, then the free
+# space is returned incrementally.  (That needs the database to have been
+# switched to incremental vacuuming, which rewrites the whole database, so is
+# done separately, by 'archive.py --vacuum', at a quiet time.)
+#
+
+import argparse
+import logging
+import re
+import sqlite3
+import time
+
+import carpetbag
+
+# jobs in these statuses won't change any more
+#
+# (not 'build succeeded' or 'deploy failed', which can still be deployed with
+# 'jobs deploy', and only jobs in the hot table can change status)
+terminal_statuses = ['build failed', 'cancelled', 'superseded', 'dispatch failed', 'not built', 'deployed', 'errored']
+
+# jobs older than this are archived
+threshold_days = 90
+
+# jobs moved per transaction, and the pause between transactions
+batch = 200
+pause = 0.1
+
+# pages freed per incremental vacuum step
+vacuum_pages = 1000
+
+interval = 24 * 60 * 60
+last_run = 0
+
+
+def _columns(conn, schema, table):
+    return [r[1] for r in conn.execute('PRAGMA %s.table_info(%s)' % (schema, table))]
+
+
+def _ensure_schema(conn):
+    # create the archive tables like the hot ones, and add any columns which
+    # have since been added to the hot ones
+    for table in ['jobs', 'transitions']:
+        if not conn.execute("SELECT 1 FROM archive.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone():
+            (sql,) = conn.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            conn.execute(re.sub(r'^CREATE TABLE\s+\w+', 'CREATE TABLE archive.%s' % table, sql))
+
+        archived = _columns(conn, 'archive', table)
+        for (_, name, coltype, notnull, default, _) in conn.execute('PRAGMA main.table_info(%s)' % table).fetchall():
+            if name not in archived:
+                conn.execute('ALTER TABLE archive.%s ADD COLUMN %s %s%s%s' % (table, name, coltype,
+                                                                              ' NOT NULL' if notnull and default is not None else '',
+                                                                              ' DEFAULT %s' % default if default is not None else ''))
+
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.jobs_timestamp ON jobs (timestamp)')
+    conn.execute('CREATE INDEX IF NOT EXISTS archive.transitions_job_id ON transitions (job_id)')
+
+
+def move(conn, cutoff):
+    # move a batch of jobs, returning the number moved
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        ids = [r[0] for r in conn.execute('SELECT id FROM main.jobs WHERE timestamp < ? AND status IN (%s) ORDER BY id LIMIT ?' %
+                                          ', '.join('?' * len(terminal_statuses)),
+                                          (cutoff,) + tuple(terminal_statuses) + (batch,))]
+        if ids:
+            placeholders = ', '.join('?' * len(ids))
+            for (table, key) in [('jobs', 'id'), ('transitions', 'job_id')]:
+                cols = ', '.join(_columns(conn, 'main', table))
+                conn.execute('INSERT INTO archive.%s (%s) SELECT %s FROM main.%s WHERE %s IN (%s)' % (table, cols, cols, table, key, placeholders), ids)
+                conn.execute('DELETE FROM main.%s WHERE %s IN (%s)' % (table, key, placeholders), ids)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+    return len(ids)
+
+
+def vacuum():
+    # switch to incremental vacuuming, which needs a full vacuum, during which
+    # nothing else can use the database
+    conn = sqlite3.connect(carpetbag.dbfile, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA main.auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM main')
+    conn.close()
+
+
+def compact(conn):
+    # return free pages a few at a time (if the database has been switched to
+    # incremental vacuuming, see vacuum())
+    (mode,) = conn.execute('PRAGMA main.auto_vacuum').fetchone()
+    if mode != 2:
+        logging.info("archive: free space not returned, run 'archive.py --vacuum' to enable that")
+        return
+
+    while conn.execute('PRAGMA main.freelist_count').fetchone()[0] > 0:
+        conn.execute('PRAGMA main.incremental_vacuum(%d)' % vacuum_pages).fetchall()
+        time.sleep(pause)
+
+    conn.execute('PRAGMA main.optimize')
+
+
+def archive(days=None):
+    cutoff = time.time() - (days if days is not None else threshold_days) * 24 * 60 * 60
+
+    # (autocommit, transactions are explicit)
+    conn = sqlite3.connect(carpetbag.dbfile, timeout=30, isolation_level=None)
+    conn.execute('ATTACH DATABASE ? AS archive', (carpetbag.archivefile,))
+    _ensure_schema(conn)
+
+    moved = 0
+    while True:
+        n = move(conn, cutoff)
+        moved += n
+        if n < batch:
+            break
+        time.sleep(pause)
+
+    conn.execute('DETACH DATABASE archive')
+    if moved:
+        logging.info('archive: moved %d jobs' % moved)
+        compact(conn)
+    conn.close()
+
+    return moved
+
+
+def process(force=False):
+    global last_run
+    if not force and time.time() - last_run < interval:
+        return
+    last_run = time.time()
+
+    try:
+        archive()
+    except sqlite3.OperationalError as e:
+        logging.error(e)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='archive old jobs')
+    parser.add_argument('--days', type=int, default=threshold_days, help='archive jobs older than DAYS (default: %d)' % threshold_days)
+    parser.add_argument('--vacuum', action='store_true', help='switch the database to incremental vacuuming (stop scallywagd first)')
+    args = parser.parse_args()
+
+    if args.vacuum:
+        vacuum()
+        print('vacuumed %s' % carpetbag.dbfile)
+    else:
+        print('archived %d jobs' % archive(args.days))
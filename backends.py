@@ -3,25 +3,46 @@
 # slightly generic interface to backend APIs
 #
 
+import importlib
 import logging
 
-import appveyor
-import gh
-
 
 # Backend class is expected to implement the following static methods:
 #
 #     def request_build(package, maintainer, commit, reference, default_tokens, buildnumber):
 #     def cancel_build(bbid):
 #     def update_build_status(bbid):
+#     def throttle():
+#
+# and, if it provides build metadata and artifacts once the build has
+# succeeded (rather than with the status notification):
+#
+#     def examine_artifacts(bbid, u):
+#
+# examine_artifacts() fills in the metadata and artifacts of the build in u,
+# returning False if they're not available yet.
+#
+# cancel_build() returns True if the backend accepted the cancellation.
+#
+# throttle() waits until a deferrable request (dispatching or cancelling) can be
+# made without running into the API's rate limit, returning False if it can't
+# be made soon.
 
 
-def lookup_by_name(backend):
-    if backend == 'appveyor':
+# backend name -> the module implementing it
+#
+# (imported only when a backend is looked up, since that isn't needed at all
+# when a build isn't going to be dispatched)
+registry = {
+    'appveyor': 'appveyor',
+    'github': 'gh',
+    'local': 'local',
+}
+
 
-        return appveyor.Backend
-    elif backend == 'github':
-        return gh.Backend
-    else:
+def lookup_by_name(backend):
+    if backend not in registry:
         logging.warning('unknown backend: %s' % backend)
         return None
+
+    return importlib.import_module(registry[backend]).Backend
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# produce the builddir archive artifact
+#
+
+import contextlib
+import fnmatch
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import time
+
+# codec -> (tarfile mode, external compressor, file extension)
+codecs = {
+    'xz': ('xz', 'xz', '.tar.xz'),
+    'zst': (None, 'zstd', '.tar.zst'),
+    'gz': ('gz', 'gzip', '.tar.gz'),
+    'none': ('', None, '.tar'),
+}
+
+# what to archive, depending on if the build succeeded or failed:
+#
+# 'always' - everything
+# 'failure' - everything if the build failed, only logs if it succeeded
+# 'logs' - only logs
+# 'never' - nothing
+policies = ['always', 'failure', 'logs', 'never']
+
+# files which are excluded, unless other exclusions are given (e.g. with
+# BUILDDIR_EXCLUDE)
+default_exclude = [
+    '.git/',
+    '*.o',
+    '*.obj',
+    '*.lo',
+]
+
+
+def _match(path, pattern):
+    # match against the path relative to the top of the archive, or relative
+    # to the cygport workdir (i.e. with a leading 'P-V-R.arch/' removed)
+    if fnmatch.fnmatch(path, pattern):
+        return True
+
+    if '/' in path:
+        _, rest = path.split('/', 1)
+        if fnmatch.fnmatch(rest, pattern):
+            return True
+
+    return False
+
+
+def excluded_dir(path, exclude):
+    # patterns ending in '/' match directories
+    return any(_match(path, p[:-1]) for p in exclude if p.endswith('/'))
+
+
+def excluded(path, exclude):
+    # other patterns match files, either by path or just the filename
+    for pattern in exclude:
+        if pattern.endswith('/'):
+            continue
+
+        if _match(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern):
+            return True
+
+    return False
+
+
+def is_log(path):
+    # cygport writes logs into the log/ directory of the workdir, but also
+    # keep anything else which looks like a log (config.log, test-suite.log,
+    # etc.)
+    return ('/log/' in '/' + path) or path.endswith('.log') or path.endswith('.sum')
+
+
+def walk(srcdir, exclude, logs_only, max_size):
+    for (dirpath, dirnames, files) in os.walk(srcdir):
+        reldir = os.path.relpath(dirpath, srcdir)
+        if reldir == '.':
+            reldir = ''
+
+        # prune excluded directories, so we don't descend into them
+        dirnames[:] = sorted(d for d in dirnames if not excluded_dir(os.path.join(reldir, d), exclude))
+
+        for f in sorted(files):
+            relpath = os.path.join(reldir, f)
+            if excluded(relpath, exclude):
+                continue
+            if logs_only and not is_log(relpath):
+                continue
+            # skip large files (but never logs)
+            if max_size and not is_log(relpath):
+                try:
+                    if os.lstat(os.path.join(dirpath, f)).st_size > max_size:
+                        continue
+                except OSError:
+                    pass
+            yield relpath
+
+
+def contents(policy, succeeded):
+    if policy not in policies:
+        logging.warning("unknown builddir policy '%s', using 'always'" % policy)
+        policy = 'always'
+
+    if policy == 'never':
+        return None
+    elif policy == 'logs' or (policy == 'failure' and succeeded):
+        return 'logs'
+
+    return 'all'
+
+
+def archive(dest, srcdir, codec='xz', level=None, threads=0, exclude=None, logs_only=False, max_size=None):
+    if codec not in codecs:
+        logging.warning("unknown builddir codec '%s', using 'xz'" % codec)
+        codec = 'xz'
+
+    tarmode, compressor, ext = codecs[codec]
+
+    if exclude is None:
+        exclude = default_exclude
+
+    dest = dest + ext
+    start = time.time()
+    count = 0
+
+    # prefer the external compressor, which can use multiple threads, falling
+    # back to the python module if it isn't available
+    if compressor and not shutil.which(compressor):
+        if tarmode is None:
+            logging.warning("'%s' not available, using 'xz' for builddir archive" % compressor)
+            return archive(dest[:-len(ext)], srcdir, 'xz', None, threads, exclude, logs_only, max_size)
+        compressor = None
+
+    with open(dest, 'wb') as f:
+        if compressor:
+            cmd = [compressor, '-c']
+            if level is not None:
+                cmd.append('-%d' % level)
+            if compressor in ['xz', 'zstd']:
+                cmd.append('-T%d' % threads)
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=f)
+            tar = tarfile.open(fileobj=proc.stdin, mode='w|')
+        else:
+            proc = None
+            kwargs = {}
+            if level is not None and tarmode:
+                kwargs['preset' if tarmode == 'xz' else 'compresslevel'] = level
+            tar = tarfile.open(fileobj=f, mode='w:' + tarmode, **kwargs)
+
+        # (if the compressor exits early, writing to it fails, see below)
+        try:
+            with tar:
+                for relpath in walk(srcdir, exclude, logs_only, max_size):
+                    tar.add(os.path.join(srcdir, relpath), arcname=relpath, recursive=False)
+                    count += 1
+        except BrokenPipeError:
+            if not proc:
+                raise
+
+        if proc:
+            with contextlib.suppress(BrokenPipeError):
+                proc.stdin.close()
+            proc.wait()
+
+    # (don't leave a truncated archive to be uploaded)
+    if proc and proc.returncode != 0:
+        logging.error("'%s' failed, exit status %d, no builddir archive" % (compressor, proc.returncode))
+        os.remove(dest)
+        return None
+
+    elapsed = time.time() - start
+    size = os.path.getsize(dest)
+
+    logging.info('builddir archive %s: %d files, %d bytes, %.1f seconds (codec %s, level %s)' %
+                 (os.path.basename(dest), count, size, elapsed, codec, level if level is not None else 'default'))
+
+    return dest, size, elapsed
+
+
+#
+# archive the specified directory
+#
+
+if __name__ == '__main__':
+    import argparse
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description='builddir archive')
+    parser.add_argument('--codec', action='store', choices=sorted(codecs.keys()), default='xz')
+    parser.add_argument('--level', action='store', type=int, default=None)
+    parser.add_argument('--threads', action='store', type=int, default=0)
+    parser.add_argument('--exclude', action='append', default=None, help='exclude files matching pattern (default: %s)' % ' '.join(default_exclude))
+    parser.add_argument('--logs-only', action='store_true')
+    parser.add_argument('--max-size', action='store', type=int, default=None)
+    parser.add_argument('dest')
+    parser.add_argument('srcdir')
+    args = parser.parse_args()
+
+    archive(args.dest, args.srcdir, args.codec, args.level, args.threads, args.exclude, args.logs_only, args.max_size)
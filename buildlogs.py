@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+#
+# local archive of build logs, with full-text search
+#
+# GitHub expires the logs of workflow runs, so scallywagd downloads the logs of
+# completed runs, keeps them gzipped under buildlogs/ in the staging root (a
+# file for each job in the run, i.e. each arch), and indexes them in a sqlite
+# FTS5 table, for the 'logsearch' command.
+#
+# The index is contentless (the text lives only in the compressed files), so
+# results come with snippets taken from the matching files.  Removing a log
+# from the index needs its text, so logs are removed by expire(), which reads
+# them back first.
+#
+
+import contextlib
+import gzip
+import logging
+import os
+import random
+import re
+import sqlite3
+import time
+import zipfile
+
+import carpetbag
+import gh
+import metrics
+
+storedir = os.path.join(carpetbag.stagingroot, 'buildlogs')
+dbfile = os.environ.get('SCALLYWAG_LOGS_DB', os.path.join(storedir, 'logs.db'))
+
+# jobs in these statuses have a completed run, with logs
+completed_statuses = ['build failed', 'fetching metadata', 'build succeeded', 'not built', 'fetching', 'deploying', 'deployed', 'deploy failed']
+
+# the most runs to fetch logs for each time process() is called
+batch = 10
+
+# fetching the logs of a run which fails is retried with backoff (see
+# carpetbag.retry_later()), up to this many times
+max_attempts = 8
+
+# retention limits: logs of jobs older than this are removed, and then the
+# oldest logs are removed until the archive is smaller than max_size
+retention_days = 180
+max_size = 20 * 1024 * 1024 * 1024
+
+expire_interval = 3600
+last_expire = 0
+
+
+def connect():
+    os.makedirs(storedir, exist_ok=True)
+    conn = sqlite3.connect(dbfile, timeout=30)
+    conn.execute('CREATE TABLE IF NOT EXISTS ingested (job_id INTEGER PRIMARY KEY, timestamp REAL, result TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS retries (job_id INTEGER PRIMARY KEY, attempts INTEGER, next_attempt_at REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY, job_id INTEGER, package TEXT, arch TEXT, status TEXT, '
+                 'timestamp REAL, path TEXT, size INTEGER)')
+    conn.execute('CREATE INDEX IF NOT EXISTS logs_job_id ON logs (job_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS logs_timestamp ON logs (timestamp)')
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS logs_fts USING fts5 (text, content='')")
+    return conn
+
+
+# GitHub prefixes every line with a timestamp, which isn't worth indexing
+_timestamp_re = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z ', re.MULTILINE)
+
+
+def _text(raw):
+    return _timestamp_re.sub('', raw.decode('utf-8', errors='replace'))
+
+
+def _arch(name):
+    # the log file for each job in the run is named like '1_x86_64 _ build.txt'
+    name = re.sub(r'^\d+_', '', name[:-len('.txt')])
+    return name.split(' _ ')[0].replace('i686', 'x86')
+
+
+def ingest(conn, jobid, package, status, timestamp, zipfn):
+    with zipfile.ZipFile(zipfn) as z:
+        names = [n for n in z.namelist() if '/' not in n and n.endswith('.txt')]
+
+        os.makedirs(os.path.join(storedir, str(jobid)), exist_ok=True)
+        for n in names:
+            raw = z.read(n)
+            arch = _arch(n)
+            path = os.path.join(str(jobid), '%s.log.gz' % arch)
+            with gzip.open(os.path.join(storedir, path), 'wb', compresslevel=6) as f:
+                f.write(raw)
+            size = os.path.getsize(os.path.join(storedir, path))
+
+            c = conn.execute('INSERT INTO logs (job_id, package, arch, status, timestamp, path, size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (jobid, package, arch, status, timestamp, path, size))
+            conn.execute('INSERT INTO logs_fts (rowid, text) VALUES (?, ?)', (c.lastrowid, _text(raw)))
+
+            metrics.inc('scallywag_buildlogs_bytes_total', len(raw), help='Size of build logs archived (uncompressed)')
+
+    return len(names)
+
+
+def _retry_later(conn, jobid):
+    # returns the result, if we've given up
+    row = conn.execute('SELECT attempts FROM retries WHERE job_id = ?', (jobid,)).fetchone()
+    attempts = (row[0] if row else 0) + 1
+    if attempts >= max_attempts:
+        conn.execute('DELETE FROM retries WHERE job_id = ?', (jobid,))
+        return 'gave up'
+
+    delay = min(carpetbag.retry_base * 2 ** (attempts - 1), carpetbag.retry_max_delay)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    conn.execute('INSERT OR REPLACE INTO retries (job_id, attempts, next_attempt_at) VALUES (?, ?, ?)', (jobid, attempts, time.time() + delay))
+    logging.info('logs for job %d: attempt %d failed, retrying in %ds' % (jobid, attempts, delay))
+    return None
+
+
+def fetch():
+    # ensure the index exists, before looking in it
+    connect().close()
+
+    # fetch the logs of completed runs which we haven't got yet (and aren't
+    # waiting to retry), oldest first
+    now = time.time()
+    since = now - retention_days * 24 * 60 * 60
+    with contextlib.closing(sqlite3.connect(carpetbag.dbfile, timeout=30)) as conn:
+        conn.execute('ATTACH DATABASE ? AS buildlogs', (dbfile,))
+        rows = conn.execute("SELECT id, srcpkg, status, timestamp, backend_id FROM jobs WHERE backend = 'github' AND backend_id IS NOT NULL "
+                            "AND cached_from IS NULL AND timestamp >= ? AND status IN (%s) "
+                            "AND id NOT IN (SELECT job_id FROM buildlogs.ingested) "
+                            "AND id NOT IN (SELECT job_id FROM buildlogs.retries WHERE next_attempt_at > ?) ORDER BY id LIMIT ?" % ', '.join('?' * len(completed_statuses)),
+                            (since,) + tuple(completed_statuses) + (now, batch)).fetchall()
+
+    if not rows:
+        return False
+
+    logging.info('%d runs ready for fetching logs' % len(rows))
+
+    with contextlib.closing(connect()) as conn:
+        for (jobid, package, status, timestamp, bbid) in rows:
+            # logs aren't urgent, so don't spend requests the rest of scallywag
+            # needs
+            if not gh.ratelimit_wait():
+                return True
+
+            zipfn = gh.fetch_run_logs(bbid)
+            if zipfn is None:
+                metrics.inc('scallywag_buildlogs_fetches_total', result='retry', help='Attempts to fetch build logs')
+                with conn:
+                    result = _retry_later(conn, jobid)
+                    if result:
+                        conn.execute('INSERT OR REPLACE INTO ingested (job_id, timestamp, result) VALUES (?, ?, ?)', (jobid, time.time(), result))
+                        logging.info('logs for job %d: %s' % (jobid, result))
+                continue
+
+            with conn:
+                conn.execute('DELETE FROM retries WHERE job_id = ?', (jobid,))
+                if zipfn is False:
+                    result = 'expired'
+                else:
+                    try:
+                        result = '%d logs' % ingest(conn, jobid, package, status, timestamp, zipfn)
+                    except zipfile.BadZipFile:
+                        result = 'bad zip'
+                    os.remove(zipfn)
+
+                conn.execute('INSERT OR REPLACE INTO ingested (job_id, timestamp, result) VALUES (?, ?, ?)', (jobid, time.time(), result))
+
+            logging.info('logs for job %d: %s' % (jobid, result))
+            metrics.inc('scallywag_buildlogs_fetches_total', result='ok' if zipfn else 'expired', help='Attempts to fetch build logs')
+
+    # there may be more
+    return len(rows) == batch
+
+
+def _remove(conn, rowid, path):
+    fn = os.path.join(storedir, path)
+    try:
+        with gzip.open(fn, 'rb') as f:
+            text = _text(f.read())
+        conn.execute("INSERT INTO logs_fts (logs_fts, rowid, text) VALUES ('delete', ?, ?)", (rowid, text))
+        os.remove(fn)
+    except FileNotFoundError:
+        # without the text, the index entry can't be removed, but it can't
+        # be returned by search() either
+        pass
+    conn.execute('DELETE FROM logs WHERE id = ?', (rowid,))
+
+    # remove the job directory, once empty
+    with contextlib.suppress(OSError):
+        os.rmdir(os.path.dirname(fn))
+
+
+def expire(force=False):
+    global last_expire
+    if not force and time.time() - last_expire < expire_interval:
+        return
+    last_expire = time.time()
+
+    removed = 0
+    with contextlib.closing(connect()) as conn:
+        with conn:
+            since = time.time() - retention_days * 24 * 60 * 60
+            for (rowid, path) in conn.execute('SELECT id, path FROM logs WHERE timestamp < ?', (since,)).fetchall():
+                _remove(conn, rowid, path)
+                removed += 1
+
+            conn.execute('DELETE FROM ingested WHERE timestamp < ?', (since,))
+            conn.execute('DELETE FROM retries WHERE next_attempt_at < ?', (since,))
+
+            (total,) = conn.execute('SELECT COALESCE(SUM(size), 0) FROM logs').fetchone()
+            if total > max_size:
+                for (rowid, path, size) in conn.execute('SELECT id, path, size FROM logs ORDER BY timestamp').fetchall():
+                    _remove(conn, rowid, path)
+                    removed += 1
+                    total -= size
+                    if total <= max_size:
+                        break
+
+    if removed:
+        logging.info('expired %d build logs' % removed)
+
+
+def process():
+    try:
+        incomplete = fetch()
+        expire()
+    except sqlite3.OperationalError as e:
+        logging.error(e)
+        incomplete = True
+    except OSError as e:
+        logging.error('fetching build logs failed: %s' % e)
+        incomplete = True
+
+    return incomplete
+
+
+#
+# searching
+#
+
+def _terms(query):
+    # the words of an FTS5 query, for finding snippets
+    return [t.lower() for t in re.findall(r'\w+', query) if t not in ['AND', 'OR', 'NOT', 'NEAR']]
+
+
+def snippet(path, query, context=120):
+    terms = _terms(query)
+    try:
+        with gzip.open(os.path.join(storedir, path), 'rt', errors='replace') as f:
+            for lineno, line in enumerate(f, 1):
+                lower = line.lower()
+                if any(t in lower for t in terms):
+                    line = _timestamp_re.sub('', line.rstrip())
+                    return lineno, line[:context * 2]
+    except FileNotFoundError:
+        pass
+    return None, ''
+
+
+def search(query, package=None, arch=None, status=None, limit=20):
+    # returns a list of (job_id, package, arch, status, timestamp, lineno,
+    # snippet), best match first
+    where = []
+    params = ()
+    for column, value in [('package', package), ('arch', arch), ('status', status)]:
+        if value:
+            where.append('%s GLOB ?' % column)
+            params = params + (value,)
+
+    sql = ('SELECT l.job_id, l.package, l.arch, l.status, l.timestamp, l.path FROM logs_fts f JOIN logs l ON l.id = f.rowid '
+           'WHERE logs_fts MATCH ? %s ORDER BY f.rank LIMIT ?' % ''.join(' AND l.' + w for w in where))
+
+    conn = sqlite3.connect('file:%s?mode=ro' % dbfile, uri=True)
+    rows = conn.execute(sql, (query,) + params + (limit,)).fetchall()
+    conn.close()
+
+    results = []
+    for (jobid, package, arch, status, timestamp, path) in rows:
+        lineno, text = snippet(path, query)
+        results.append((jobid, package, arch, status, timestamp, lineno, text))
+
+    return results
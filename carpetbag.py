@@ -2,10 +2,22 @@
 
 import logging
 import os
+import random
+import socket
 import sqlite3
+import threading
+import time
+
+import durations
 
 basedir = os.path.dirname(os.path.realpath(__file__))
-dbfile = os.path.join(basedir, 'carpetbag.db')
+dbfile = os.environ.get('SCALLYWAG_DB', os.path.join(basedir, 'carpetbag.db'))
+
+# old jobs in terminal states are moved to here (see archive.py)
+archivefile = os.environ.get('SCALLYWAG_ARCHIVE_DB', os.path.join(os.path.dirname(dbfile), 'carpetbag-archive.db'))
+
+# root of the staging area, logs etc. on sourceware
+stagingroot = os.environ.get('SCALLYWAG_STAGING_ROOT', '/sourceware/cygwin-staging')
 
 
 # object to hold the data for an update
@@ -24,68 +36,306 @@ def deployable_token(tokens):
     return False
 
 
+# tokens which only affect what's done with a build (or whether it's
+# requested at all), not what's built
+nonbuild_tokens = {'rebuild', 'deploy', 'nodeploy', 'nosupersede', 'disable'}
+
+
+# the tokens which determine the build, normalized so they can be compared
+def effective_tokens(tokens):
+    return ' '.join(sorted(set(tokens.split()) - nonbuild_tokens))
+
+
+# the tokens of a cached build, with the tokens it was requested with replaced
+# by those of the new request (leaving those which came from the cygport)
+def rebase_tokens(metadata_tokens, old_tokens, new_tokens):
+    words = metadata_tokens.split()
+    for t in old_tokens.split():
+        if t in words:
+            words.remove(t)
+    return ' '.join(new_tokens.split() + words)
+
+
+# statuses which a job which was successfully built can be in
+built_statuses = ['build succeeded', 'fetching', 'deploying', 'deployed', 'deploy failed']
+
+# how old a build can be and still be reused (a little less than the 90 days
+# for which GitHub retains the artifacts of a workflow run)
+cache_max_age = 80 * 24 * 60 * 60
+
+
+# find a previous successful build of the same commit with the same effective
+# tokens, whose artifacts and metadata can be reused
+#
+# (the age is that of the original build, as a cache hit copies its artifact
+# URLs)
+def lookup_cached_build(conn, package, commit, tokens):
+    cursor = conn.execute("SELECT j.id, j.arches, j.artifacts, j.announce, j.metadata_tokens, COALESCE(j.default_tokens, j.effective_tokens), "
+                          "j.backend, j.backend_id, j.logurl, j.duration, j.cached_from FROM jobs j LEFT JOIN jobs o ON o.id = j.cached_from "
+                          "WHERE j.srcpkg = ? AND j.hash = ? AND j.effective_tokens = ? AND j.metadata_tokens IS NOT NULL AND "
+                          "j.status IN (%s) AND COALESCE(o.timestamp, CASE WHEN j.cached_from IS NULL THEN j.timestamp END) >= ? "
+                          "ORDER BY j.id DESC LIMIT 1" % ', '.join('?' * len(built_statuses)),
+                          (package, commit, effective_tokens(tokens)) + tuple(built_statuses) + (time.time() - cache_max_age,))
+    return cursor.fetchone()
+
+
+# attach the archive of old jobs, read-only, to conn (which must have been
+# opened with uri=True), and create the temporary view 'all_jobs' of both hot
+# and archived jobs.  Returns the name of the table to query for all jobs.
+def attach_archive(conn):
+    if not os.path.exists(archivefile):
+        return 'jobs'
+
+    if not conn.execute("SELECT 1 FROM pragma_database_list WHERE name = 'archive'").fetchone():
+        conn.execute('ATTACH DATABASE ? AS archive', ('file:%s?mode=ro' % archivefile,))
+
+    cols = ', '.join(r[1] for r in conn.execute('PRAGMA main.table_info(jobs)'))
+    conn.execute('CREATE TEMP VIEW IF NOT EXISTS all_jobs AS SELECT %s FROM main.jobs UNION ALL SELECT %s FROM archive.jobs' % (cols, cols))
+    return 'all_jobs'
+
+
+# statuses a job can be deployed from (again, if calm failed to deploy it)
+deployable_statuses = ['build succeeded', 'deploy failed']
+
+
 def deployable_job(u):
-    return ((u.status == 'build succeeded') and
+    return ((u.status in deployable_statuses) and
             ((u.reference == 'refs/heads/master') or
              (u.reference == 'refs/heads/main')) and
             (u.package != 'playground'))
 
 
-def update_backend_id(u):
-    logging.info(vars(u))
+# the job state machine
+#
+# For each status, the statuses a job can move to it from.  Every status change
+# is made conditional on the job still being in one of those statuses, so a
+# change which isn't listed (e.g. a late 'pending' notification for a job which
+# has since completed, or a completion notification for a job which has been
+# superseded) doesn't happen.
+transitions = {
+    # (back to 'queued' if dispatching is deferred)
+    'queued': ['requested'],
+    'requested': ['queued'],
+    'dispatch failed': ['requested'],
+    'pending': ['requested'],
+    'build succeeded': ['requested', 'pending', 'fetching metadata'],
+    'build failed': ['requested', 'pending'],
+    'cancelled': ['queued', 'requested', 'pending'],
+    'superseded': ['queued', 'requested', 'pending'],
+    'fetching metadata': ['requested', 'pending', 'build succeeded'],
+    'not built': ['build succeeded', 'fetching metadata'],
+    'fetching': ['build succeeded', 'fetching metadata', 'deploy failed'],
+    'deploying': ['fetching'],
+    'deployed': ['deploying'],
+    'deploy failed': ['deploying'],
+    # (gave up retrying)
+    'errored': ['fetching metadata', 'fetching'],
+}
+
+_local = threading.local()
+
+
+# a connection to the database, kept open for reuse by later events (one per
+# thread, as sqlite connections can't be shared between them)
+def connection():
+    if getattr(_local, 'dbfile', None) != dbfile:
+        _local.conn = sqlite3.connect(dbfile, timeout=30)
+        _local.dbfile = dbfile
+    return _local.conn
+
+
+# move job to status, setting any other columns given in fields, if that's a
+# legal transition from the status it's in (and it's in the status expected, if
+# given).  Returns True if the transition was made.
+#
+# The caller is responsible for the transaction this happens in.
+def transition(conn, jobid, status, fields=None, expected=None):
+    sources = transitions[status]
+    if expected is not None:
+        sources = [s for s in sources if s == expected]
+
+    # (and restart the count of attempts, and release any lease, for the new
+    # status)
+    fields = dict(fields or {}, attempts=0, next_attempt_at=0, worker_id=None, lease_expires=0)
+    assignments = ', '.join(['status = ?'] + ['%s = ?' % k for k in fields])
+    sql = 'UPDATE jobs SET %s WHERE id = ? AND status IN (%s)' % (assignments, ', '.join('?' * len(sources)))
+    c = conn.execute(sql, (status,) + tuple(fields.values()) + (jobid,) + tuple(sources))
+    if c.rowcount:
+        return True
+
+    row = conn.execute('SELECT status FROM jobs WHERE id = ?', (jobid,)).fetchone()
+    if not row or row[0] != status:
+        logging.info('job %s: not moving from %s to %s' % (jobid, row[0] if row else 'nonexistent', status))
+    return False
+
+
+# retrying
+#
+# A job whose processing in a status fails (e.g. fetching metadata or artifacts)
+# is retried after an exponentially increasing, jittered, delay, until it's
+# been in that status for longer than the deadline, when it's given up on.
+retry_base = 60
+retry_max_delay = 3600
+retry_deadline = {
+    'fetching metadata': 24 * 60 * 60,
+    'fetching': 24 * 60 * 60,
+}
+
+
+# an attempt to process job in status failed, so schedule another attempt, or
+# move it to 'errored' if it's past the deadline.  Returns True if the job
+# errored.
+#
+# The caller is responsible for the transaction this happens in.
+def retry_later(conn, jobid, status):
+    row = conn.execute('SELECT attempts FROM jobs WHERE id = ? AND status = ?', (jobid, status)).fetchone()
+    if not row:
+        return False
+    attempts = row[0] + 1
+
+    (since,) = conn.execute('SELECT MAX(timestamp) FROM transitions WHERE job_id = ? AND status = ?', (jobid, status)).fetchone()
+    if since is not None and time.time() - since > retry_deadline[status]:
+        logging.info('job %d: giving up on %s after %d attempts' % (jobid, status, attempts))
+        return transition(conn, jobid, 'errored', expected=status)
+
+    # (equal jitter: half the delay, plus a random amount up to the other half)
+    delay = min(retry_base * 2 ** (attempts - 1), retry_max_delay)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    logging.info('job %d: %s attempt %d failed, retrying in %ds' % (jobid, status, attempts, delay))
+    conn.execute('UPDATE jobs SET attempts = ?, next_attempt_at = ? WHERE id = ?', (attempts, time.time() + delay, jobid))
+    return False
+
+
+# leases
+#
+# A job being processed by a worker (fetching metadata or artifacts) is leased
+# to it, so that several workers can share the work without processing the same
+# job at once.  A worker renews the leases it holds while it's alive (see
+# heartbeat()), so a lease which has expired was held by a worker which has
+# died, and the job can be claimed by another.
+lease_duration = 600
+
+
+def worker():
+    # (not fixed at import, as the daemon forks)
+    return '%s:%d' % (socket.gethostname(), os.getpid())
 
-    with sqlite3.connect(dbfile) as conn:
-        conn.execute('UPDATE jobs SET backend_id = ? WHERE id = ?', (u.backend_id, u.buildnumber))
 
-    conn.close()
+# claim (up to limit) jobs in status which are due an attempt, and either
+# unleased or whose lease has expired, in order of id, after the job id after.
+# Returns the ids of the jobs claimed.
+def claim(conn, status, after=0, limit=10):
+    now = time.time()
+    with conn:
+        rows = conn.execute('UPDATE jobs SET worker_id = ?, lease_expires = ? WHERE id IN '
+                            '(SELECT id FROM jobs WHERE status = ? AND next_attempt_at <= ? AND lease_expires <= ? AND id > ? ORDER BY id LIMIT ?) '
+                            'RETURNING id', (worker(), now + lease_duration, status, now, now, after, limit)).fetchall()
+    return sorted(r[0] for r in rows)
 
 
+def release(conn, jobids):
+    with conn:
+        conn.execute('UPDATE jobs SET worker_id = NULL, lease_expires = 0 WHERE worker_id = ? AND id IN (%s)' % ', '.join('?' * len(jobids)),
+                     (worker(),) + tuple(jobids))
+
+
+def renew_leases():
+    conn = connection()
+    with conn:
+        c = conn.execute('UPDATE jobs SET lease_expires = ? WHERE worker_id = ?', (time.time() + lease_duration, worker()))
+    return c.rowcount
+
+
+# start a thread which renews this process's leases, well before they expire
+def heartbeat():
+    def renew():
+        while True:
+            time.sleep(lease_duration / 4)
+            try:
+                renew_leases()
+            except sqlite3.Error as e:
+                logging.error('renewing leases failed: %s' % e)
+
+    t = threading.Thread(target=renew, name='heartbeat', daemon=True)
+    t.start()
+    return t
+
+
+# a status notification from the backend
 def update_status(u):
     logging.info(vars(u))
 
-    with sqlite3.connect(dbfile) as conn:
-        conn.execute('UPDATE jobs SET status = ?, logurl = ?, duration = ? WHERE id = ?',
-                     (u.status, u.buildurl, u.duration, u.buildnumber))
+    status = u.status
+    # The only piece of new data the metadata actually provides is the updated
+    # token set, after adding tokens from the cygport itself, so a successful
+    # build without it goes on to fetching that
+    if status == 'build succeeded' and not hasattr(u, 'tokens'):
+        status = 'fetching metadata'
 
-        if u.status != 'build succeeded':
-            return
+    conn = connection()
+    with conn:
+        # ensure backend_id is set, if it was previously unknown due to
+        # timeout waiting for it to be assigned
+        if getattr(u, 'backend_id', None) is not None:
+            conn.execute('UPDATE jobs SET backend_id = ? WHERE id = ?', (u.backend_id, u.buildnumber))
 
-        # The only piece of new data the metadata actually provides is the
-        # updated token set, after adding tokens from the cygport itself
-        if not hasattr(u, 'tokens'):
-            conn.execute("UPDATE jobs SET status = 'fetching metadata' WHERE id = ?", (u.buildnumber,))
+        if transition(conn, u.buildnumber, status, {'logurl': u.buildurl, 'duration': u.duration}):
+            # update the model of build durations
+            if u.status == 'build succeeded' and u.duration:
+                (package,) = conn.execute('SELECT srcpkg FROM jobs WHERE id = ?', (u.buildnumber,)).fetchone()
+                durations.record(conn, package, u.duration)
+        else:
+            # a superseded job stays superseded, whatever the outcome of the
+            # build, but record the outcome
+            conn.execute("UPDATE jobs SET logurl = ?, duration = ? WHERE id = ? AND status = 'superseded'",
+                         (u.buildurl, u.duration, u.buildnumber))
 
-    conn.close()
+        # the time the backend started running the job isn't a status
+        # transition we see, so record it explicitly (once)
+        if getattr(u, 'started', None):
+            conn.execute("INSERT INTO transitions (job_id, status, timestamp) SELECT ?, 'started', ? "
+                         "WHERE NOT EXISTS (SELECT 1 FROM transitions WHERE job_id = ? AND status = 'started')",
+                         (u.buildnumber, u.started, u.buildnumber))
 
 
+# the metadata of a successful build has been fetched
 def update_metadata(u):
     logging.info(vars(u))
 
-    with sqlite3.connect(dbfile) as conn:
+    conn = connection()
+    with conn:
         if 'nobuild' in u.tokens:
-            conn.execute("UPDATE jobs SET status = 'not built' WHERE id = ?", (u.buildnumber,))
+            transition(conn, u.buildnumber, 'not built')
             return
 
-        # sort, because it's important that 'arch' and 'artifacts' are in the same order!
-        u.arch_list = ' '.join(sorted(u.artifacts.keys()))
-        conn.execute("UPDATE jobs SET arches = ?, artifacts = ?, announce = ? WHERE id = ?", (u.arch_list, ' '.join([u.artifacts[a] for a in sorted(u.artifacts.keys())]), u.announce, u.buildnumber))
-
         if not hasattr(u, 'status'):
             u.status = 'build succeeded'
 
-        conn.execute("UPDATE jobs SET status = ? WHERE id = ?", (u.status, u.buildnumber))
+        # sort, because it's important that 'arch' and 'artifacts' are in the same order!
+        u.arch_list = ' '.join(sorted(u.artifacts.keys()))
+        fields = {
+            'arches': u.arch_list,
+            'artifacts': ' '.join([u.artifacts[a] for a in sorted(u.artifacts.keys())]),
+            'announce': u.announce,
+            'metadata_tokens': u.tokens,
+        }
 
-    conn.close()
-    deploy(u)
+        # go straight on to fetching, if it's to be deployed
+        if deployable_job(u) and deployable_token(u.tokens):
+            transition(conn, u.buildnumber, 'fetching', fields)
+        elif not transition(conn, u.buildnumber, u.status, fields, expected='fetching metadata'):
+            # the metadata arrived with the status notification, so there's no
+            # change of status
+            conn.execute('UPDATE jobs SET %s WHERE id = ? AND status = ?' % ', '.join('%s = ?' % k for k in fields),
+                         tuple(fields.values()) + (u.buildnumber, u.status))
 
 
 # Doing the fetch and deploy under the 'apache' user is not a good idea.
 # Instead we mark the build as ready to fetch, which a separate process does.
 def deploy(u, force=False):
     if deployable_job(u) and (deployable_token(u.tokens) or force):
-        with sqlite3.connect(dbfile) as conn:
-            conn.execute("UPDATE jobs SET status = 'fetching' WHERE id = ?", (u.buildnumber,))
-        conn.close()
-        return True
+        conn = connection()
+        with conn:
+            return transition(conn, u.buildnumber, 'fetching')
 
     return False
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# content-addressed store for staged artifact files
+#
+# Files are keyed by their sha512 digest (as calm uses), and staged files are
+# hardlinks to the object in the store, so reruns which produce identical
+# package files don't consume any more space.
+#
+# An object which is no longer linked to from anywhere outside the store (i.e.
+# it's link count has dropped to 1, because calm has consumed or removed the
+# staging directory) is garbage, and is removed by gc().
+#
+# (The store must be on the same filesystem as the staging area, for
+# hardlinking to work)
+#
+
+import hashlib
+import logging
+import os
+import stat
+import time
+
+import carpetbag
+
+storedir = os.path.join(carpetbag.stagingroot, 'cas')
+
+gc_interval = 3600
+last_gc = 0
+
+
+def _digest(fn):
+    sha512 = hashlib.sha512()
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha512.update(chunk)
+    return sha512.hexdigest()
+
+
+def _object_path(digest):
+    return os.path.join(storedir, 'objects', digest[:2], digest[2:])
+
+
+def _link(obj, fn):
+    # atomically replace fn with a hardlink to obj
+    tmp = fn + '.cas-tmp'
+    os.link(obj, tmp)
+    os.replace(tmp, fn)
+
+
+def add(fn):
+    # returns the number of bytes saved by deduplicating fn
+    st = os.lstat(fn)
+    if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+        return 0
+
+    obj = _object_path(_digest(fn))
+
+    try:
+        ost = os.stat(obj)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        try:
+            os.link(fn, obj)
+            return 0
+        except FileExistsError:
+            # lost a race with another process adding the same content
+            ost = os.stat(obj)
+
+    if (ost.st_dev, ost.st_ino) == (st.st_dev, st.st_ino):
+        return 0
+
+    # paranoia: a digest collision is vanishingly unlikely, but a truncated
+    # object isn't
+    if ost.st_size != st.st_size:
+        logging.warning('cas: object %s size mismatch with %s, not deduplicating' % (obj, fn))
+        return 0
+
+    _link(obj, fn)
+    return st.st_size
+
+
+def add_tree(path):
+    # deduplicate all the files in a directory tree
+    saved = 0
+    count = 0
+    for (dirpath, _, files) in os.walk(path):
+        for f in files:
+            try:
+                saved += add(os.path.join(dirpath, f))
+                count += 1
+            except OSError as e:
+                # failing to deduplicate isn't fatal, the file is still there
+                logging.warning('cas: %s' % e)
+
+    logging.info('cas: %d files in %s, deduplication saved %d bytes' % (count, path, saved))
+    return saved
+
+
+def _objects():
+    objdir = os.path.join(storedir, 'objects')
+    if not os.path.isdir(objdir):
+        return
+
+    for prefix in os.listdir(objdir):
+        d = os.path.join(objdir, prefix)
+        for f in os.listdir(d):
+            yield os.path.join(d, f)
+
+
+def stats():
+    # returns (objects, bytes stored, bytes saved)
+    #
+    # an object with a link count of n is referenced n-1 times outside the
+    # store, and so saves n-2 copies
+    objects = 0
+    stored = 0
+    saved = 0
+    for obj in _objects():
+        st = os.stat(obj)
+        objects += 1
+        stored += st.st_size
+        saved += st.st_size * max(st.st_nlink - 2, 0)
+
+    return objects, stored, saved
+
+
+def gc(force=False):
+    global last_gc
+
+    now = time.time()
+    if not force and (now - last_gc) < gc_interval:
+        return
+    last_gc = now
+
+    removed = 0
+    freed = 0
+    for obj in _objects():
+        st = os.stat(obj)
+        if st.st_nlink <= 1:
+            os.remove(obj)
+            removed += 1
+            freed += st.st_size
+
+    objects, stored, saved = stats()
+    logging.info('cas: gc removed %d objects (%d bytes), %d objects (%d bytes) remain, deduplication currently saving %d bytes' %
+                 (removed, freed, objects, stored, saved))
+
+
+if __name__ == '__main__':
+    import sys
+
+    logging.getLogger().setLevel(logging.INFO)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'gc':
+        gc(force=True)
+    else:
+        objects, stored, saved = stats()
+        print('%d objects, %d bytes stored, %d bytes saved' % (objects, stored, saved))
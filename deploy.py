@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#
+# follow jobs through deployment by calm
+#
+# fetch.fetch() stages each arch of a job in staging/<buildid>/<user>/<arch>/release,
+# marked '!ready', and asks for calm to be woken (by touching staging/.touch).
+# calm removes the files it consumes, including the '!ready' marker, or leaves
+# an '!error' marker if it couldn't deploy them.
+#
+# scallywagd watches the staging directories of jobs which are deploying (with
+# inotify, if available, and by scanning each cycle otherwise), and moves them
+# to 'deployed' or 'deploy failed' once calm is done with them.
+#
+# Waking calm is debounced, so a burst of jobs being staged only wakes it once.
+#
+
+import contextlib
+import glob
+import logging
+import os
+import pathlib
+import sqlite3
+import time
+
+import carpetbag
+import metrics
+
+ready_marker = '!ready'
+error_marker = '!error'
+
+# calm is woken once nothing more has been staged for wake_quiet seconds, but
+# no later than wake_max_delay seconds after the first request
+wake_quiet = 10
+wake_max_delay = 60
+
+_wake_first = None
+_wake_last = None
+
+
+def stagingdir():
+    return os.path.join(carpetbag.stagingroot, 'staging')
+
+
+def jobdir(buildid):
+    return os.path.join(stagingdir(), str(buildid))
+
+
+def request_wake():
+    global _wake_first, _wake_last
+    _wake_last = time.time()
+    if _wake_first is None:
+        _wake_first = _wake_last
+
+
+# wake calm, if that's been requested and is due.  Returns the time in seconds
+# until it will be due, or None if there's no request outstanding.
+def wake(force=False):
+    global _wake_first, _wake_last
+    if _wake_first is None:
+        return None
+
+    now = time.time()
+    due = min(_wake_last + wake_quiet, _wake_first + wake_max_delay)
+    if not force and now < due:
+        return due - now
+
+    logging.info('waking calm')
+    pathlib.Path(stagingdir(), '.touch').touch()
+    metrics.inc('scallywag_calm_wakes_total', help='Times calm was woken to process staging')
+    _wake_first = _wake_last = None
+    return None
+
+
+def _deploying():
+    with contextlib.closing(sqlite3.connect(carpetbag.dbfile, timeout=30)) as conn:
+        return [r[0] for r in conn.execute("SELECT id FROM jobs WHERE status = 'deploying'")]
+
+
+# the directories to watch for calm consuming the staged jobs
+def watch_paths():
+    paths = []
+    for buildid in _deploying():
+        paths.append(jobdir(buildid))
+        paths.extend(glob.glob(os.path.join(jobdir(buildid), '*', '*', 'release')))
+    return paths
+
+
+# the outcome of deploying the job staged in path: 'deployed', 'deploy failed'
+# or None (if calm hasn't finished with it yet), and the time the staging
+# directory last changed
+def examine(path):
+    markers = set()
+    latest = None
+    for dirpath, dirnames, filenames in os.walk(path):
+        markers.update(f for f in filenames if f in [ready_marker, error_marker])
+        with contextlib.suppress(OSError):
+            latest = max(latest or 0, os.stat(dirpath).st_mtime)
+
+    if error_marker in markers:
+        return 'deploy failed', latest
+    if ready_marker in markers:
+        return None, latest
+    return 'deployed', latest
+
+
+# remove any error markers left by calm from an earlier attempt to deploy the
+# job, before it's staged again
+def clear_errors(buildid):
+    for dirpath, dirnames, filenames in os.walk(jobdir(buildid)):
+        if error_marker in filenames:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(dirpath, error_marker))
+
+
+def _prune(path):
+    # remove the job's staging directory, once calm has emptied it
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        with contextlib.suppress(OSError):
+            os.rmdir(dirpath)
+
+
+def process():
+    for buildid in _deploying():
+        path = jobdir(buildid)
+        status, latest = examine(path)
+        if not status:
+            continue
+
+        # (if the directory has gone, we can't tell when calm finished with
+        # it, so it was no earlier than now)
+        timestamp = min(latest or time.time(), time.time())
+
+        conn = carpetbag.connection()
+        with conn:
+            if not carpetbag.transition(conn, buildid, status):
+                continue
+            # (only the transition just made, not any earlier one to the same
+            # status, e.g. if a job which failed to deploy was deployed again)
+            conn.execute('UPDATE transitions SET timestamp = ? WHERE rowid = (SELECT MAX(rowid) FROM transitions WHERE job_id = ? AND status = ?)',
+                         (timestamp, buildid, status))
+
+        logging.info('job %d: %s' % (buildid, status))
+        metrics.inc('scallywag_deploys_total', result='ok' if status == 'deployed' else 'failed', help='Jobs deployed by calm')
+
+        if status == 'deployed':
+            _prune(path)
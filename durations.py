@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# model of how long builds take, for estimating how long a build will take
+#
+# For each package, the durations of its most recent successful builds (other
+# than those reused from the cache) are kept, with their median and 90th
+# percentile.  It's updated as each build completes (see
+# carpetbag.update_status()).  Packages with too little history use the model
+# of all packages.
+#
+# (A job's duration is that of the whole run, building all the arches, so
+# there's no model per arch)
+#
+
+import json
+import statistics
+import time
+
+# the package name under which all packages are modelled
+ALL = '*'
+
+# the number of recent durations kept for each package
+window = 20
+
+# the fewest durations which are a useful model of a package
+min_samples = 3
+
+# the duration expected when there's no useful history at all
+default_duration = 30 * 60
+
+# a build is overdue when it's been running this many times the 90th
+# percentile of its package's durations
+overdue_factor = 2
+
+
+def _percentile(values, p):
+    # nearest-rank
+    values = sorted(values)
+    k = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(k, len(values) - 1)]
+
+
+def _store(conn, key, samples):
+    conn.execute('INSERT OR REPLACE INTO durations (package, samples, count, median, p90, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                 (key, json.dumps(samples), len(samples), statistics.median(samples), _percentile(samples, 90), time.time()))
+
+
+def record(conn, package, duration):
+    for key in [package, ALL]:
+        row = conn.execute('SELECT samples FROM durations WHERE package = ?', (key,)).fetchone()
+        samples = json.loads(row[0]) if row else []
+        _store(conn, key, (samples + [duration])[-window:])
+
+
+def estimate(conn, package, cache=None):
+    # returns the (median, 90th percentile) duration of a build of package
+    if cache is not None and package in cache:
+        return cache[package]
+
+    models = {r[0]: r[1:] for r in conn.execute('SELECT package, count, median, p90 FROM durations WHERE package IN (?, ?)', (package, ALL))}
+    result = (default_duration, default_duration)
+    for key in [package, ALL]:
+        if key in models and models[key][0] >= min_samples:
+            result = models[key][1:]
+            break
+
+    if cache is not None:
+        cache[package] = result
+    return result
+
+
+def progress(conn, jobid, package, cache=None):
+    # for a running job, returns the estimated time remaining (negative if it's
+    # taking longer than the median), and if it's overdue
+    (started,) = conn.execute("SELECT COALESCE(MAX(CASE WHEN status = 'started' THEN timestamp END), MAX(timestamp)) FROM transitions "
+                              "WHERE job_id = ? AND status IN ('started', 'pending')", (jobid,)).fetchone()
+    if started is None:
+        return None, False
+
+    median, p90 = estimate(conn, package, cache)
+    elapsed = time.time() - started
+    return median - elapsed, elapsed > overdue_factor * p90
+
+
+def overdue(conn):
+    # returns the ids of the running jobs which are overdue (and so perhaps
+    # hung, and worth cancelling)
+    cache = {}
+    c = conn.execute("SELECT id, srcpkg FROM jobs WHERE status = 'pending'")
+    return [jobid for (jobid, package) in c.fetchall() if progress(conn, jobid, package, cache)[1]]
+
+
+def rebuild(conn):
+    # (re)build the model from the history of jobs
+    history = {}
+    c = conn.execute("SELECT srcpkg, duration FROM jobs WHERE status IN ('build succeeded', 'fetching', 'deploying', 'deployed', 'deploy failed') "
+                     "AND duration IS NOT NULL AND cached_from IS NULL ORDER BY id")
+    for (package, duration) in c:
+        for key in [package, ALL]:
+            history.setdefault(key, []).append(duration)
+
+    conn.execute('DELETE FROM durations')
+    for key, samples in history.items():
+        _store(conn, key, samples[-window:])
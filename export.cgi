@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+#
+# export job history, as NDJSON or CSV (see export.py)
+#
+# e.g. export.cgi?format=csv&since_id=1234&status=deployed&package=python*
+#      export.cgi?since=7d&user=jturney
+#
+# The response is gzip compressed, if the client accepts that.
+#
+
+import cgi
+import os
+import sys
+
+import export
+import utils
+
+
+def bad_request(message):
+    print('Status: 400 Bad Request')
+    print('Content-Type: text/plain')
+    print()
+    print(message)
+
+
+def main(parse):
+    fmt = parse.getfirst('format', 'ndjson')
+    if fmt not in export.formats:
+        bad_request('unknown format %s' % fmt)
+        return
+
+    try:
+        filters = {
+            'since_id': int(parse.getfirst('since_id', 0)),
+            'status': parse.getlist('status'),
+            'package': parse.getfirst('package'),
+            'user': parse.getfirst('user'),
+            'since': utils.parse_date(parse.getfirst('since')) if 'since' in parse else None,
+            'archived': 'archive' in parse,
+            'limit': int(parse.getfirst('limit')) if 'limit' in parse else None,
+        }
+    except ValueError as e:
+        bad_request('invalid parameter: %s' % e)
+        return
+
+    compress = 'gzip' in os.environ.get('HTTP_ACCEPT_ENCODING', '')
+
+    out = sys.stdout.buffer
+    out.write(b'Content-Type: %s\n' % (b'text/csv' if fmt == 'csv' else b'application/x-ndjson'))
+    if compress:
+        out.write(b'Content-Encoding: gzip\n')
+    out.write(b'\n')
+
+    export.export(out, fmt, compress, **filters)
+    out.flush()
+
+
+if __name__ == "__main__":
+    try:
+        main(cgi.FieldStorage())
+    except Exception:
+        # allow cgitb to do it's thing
+        #
+        # (cgitb is slow to import, so only when it's needed)
+        import cgitb
+        cgitb.enable()
+        raise
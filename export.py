@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# export job history, as NDJSON or CSV
+#
+# Rows are streamed in order of id, so memory use doesn't depend on the number
+# of rows, and a consumer can sync incrementally by asking only for rows after
+# the last id it has (--since-id).
+#
+# (Rows are read a chunk at a time, each chunk in a short read of its own,
+# rather than through a single cursor, so that a slow consumer doesn't hold a
+# read lock on the database, which would keep the webhook and daemon from
+# writing to it)
+#
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import sqlite3
+import sys
+
+import carpetbag
+import utils
+
+formats = ['ndjson', 'csv']
+
+# rows read at once
+chunk = 1000
+
+
+def rows(since_id=0, status=None, package=None, user=None, since=None, archived=False, limit=None):
+    # yields the column names, then each row
+    conn = sqlite3.connect('file:%s?mode=ro' % carpetbag.dbfile, uri=True, timeout=30)
+    table = carpetbag.attach_archive(conn) if archived else 'jobs'
+
+    where = ['id > ?']
+    params = ()
+    if status:
+        where.append('status IN (%s)' % ', '.join('?' * len(status)))
+        params = params + tuple(status)
+    if package:
+        where.append('srcpkg GLOB ?')
+        params = params + (package,)
+    if user:
+        where.append('user = ?')
+        params = params + (user,)
+    if since:
+        where.append('timestamp >= ?')
+        params = params + (since,)
+
+    sql = 'SELECT * FROM %s WHERE %s ORDER BY id LIMIT ?' % (table, ' AND '.join(where))
+    c = conn.execute(sql, (since_id,) + params + (0,))
+    yield [d[0] for d in c.description]
+
+    last = since_id
+    remaining = limit
+    while remaining is None or remaining > 0:
+        n = chunk if remaining is None else min(chunk, remaining)
+        batch = conn.execute(sql, (last,) + params + (n,)).fetchall()
+        yield from batch
+
+        if len(batch) < n:
+            break
+        last = batch[-1][0]
+        if remaining is not None:
+            remaining -= len(batch)
+
+    conn.close()
+
+
+def export(out, fmt='ndjson', compress=False, **filters):
+    # write the rows to the binary stream out, returning the number written
+    # and the id of the last one
+    if compress:
+        out = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6)
+    text = io.TextIOWrapper(out, encoding='utf-8', newline='', write_through=False)
+
+    it = rows(**filters)
+    columns = next(it)
+    if fmt == 'csv':
+        writer = csv.writer(text)
+        writer.writerow(columns)
+
+    count = 0
+    last = None
+    for r in it:
+        if fmt == 'csv':
+            writer.writerow(r)
+        else:
+            text.write(json.dumps(dict(zip(columns, r))) + '\n')
+        count += 1
+        last = r[0]
+
+    text.flush()
+    # (leave out open for the caller, but finish the gzip stream)
+    text.detach()
+    if compress:
+        out.close()
+
+    return count, last
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export job history')
+    parser.add_argument('--format', choices=formats, default='ndjson', help='output format (default: ndjson)')
+    parser.add_argument('--gzip', action='store_true', help='compress output')
+    parser.add_argument('--output', '-o', metavar='FILE', help='write to FILE (default: stdout)')
+    parser.add_argument('--since-id', type=int, default=0, metavar='ID', help='only jobs after ID')
+    parser.add_argument('--status', action='append', help='only jobs in STATUS (may be repeated)')
+    parser.add_argument('--package', metavar='GLOB', help='only packages matching GLOB')
+    parser.add_argument('--user', help='only jobs requested by USER')
+    parser.add_argument('--since', metavar='DATE', help='only jobs requested since DATE (YYYY-MM-DD, or Nd for N days ago)')
+    parser.add_argument('--archived', action='store_true', help='include archived jobs')
+    parser.add_argument('--limit', type=int, help='at most LIMIT jobs')
+    args = parser.parse_args()
+
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    count, last = export(out, args.format, args.gzip, since_id=args.since_id, status=args.status, package=args.package,
+                         user=args.user, since=utils.parse_date(args.since) if args.since else None,
+                         archived=args.archived, limit=args.limit)
+    out.close()
+
+    # (for the next --since-id)
+    print('exported %d jobs%s' % (count, ', last id %d' % last if last else ''), file=sys.stderr)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+#
+# a local stand-in for the parts of the GitHub REST API which we use, for
+# offline testing and benchmarking
+#
+# (point SCALLYWAG_GITHUB_API at it)
+#
+
+import http.server
+import io
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zipfile
+
+
+class Config:
+    def __init__(self, latency=0.0, failure_rate=0.0, artifact_size=64 * 1024, run_duration=0.0, failure_conclusion_rate=0.0,
+                 ratelimit=5000):
+        # mean latency added to every response (seconds)
+        self.latency = latency
+        # fraction of requests which fail with a 500 status
+        self.failure_rate = failure_rate
+        # size of the package file in each package artifact (bytes)
+        self.artifact_size = artifact_size
+        # how long after being dispatched a run completes (seconds)
+        self.run_duration = run_duration
+        # fraction of runs which conclude with failure
+        self.failure_conclusion_rate = failure_conclusion_rate
+        # requests allowed per hour
+        self.ratelimit = ratelimit
+
+
+def _iso8601(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
+
+class State:
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.next_id = 1000
+        self.requests = 0
+        self.failures = 0
+        self.ratelimit_used = 0
+        self.ratelimit_reset = int(time.time()) + 3600
+        self._payload = None
+
+        # there's always some history of previous runs
+        self.dispatch({'event_type': '(0) previous', 'client_payload': {}})
+
+    def payload(self):
+        # the content of a package file (random, so it doesn't compress)
+        if self._payload is None or len(self._payload) != self.config.artifact_size:
+            self._payload = random.randbytes(self.config.artifact_size)
+        return self._payload
+
+    def dispatch(self, data):
+        with self.lock:
+            self.next_id += 1
+            run_id = self.next_id
+            failed = random.random() < self.config.failure_conclusion_rate
+            self.runs[run_id] = {
+                'id': run_id,
+                'display_title': data.get('event_type', ''),
+                'client_payload': data.get('client_payload', {}),
+                'created_at': time.time(),
+                'conclusion': 'failure' if failed else 'success',
+                'cancelled': False,
+            }
+        return run_id
+
+    def run(self, run_id, base_url):
+        with self.lock:
+            r = self.runs.get(run_id)
+            if not r:
+                return None
+
+            now = time.time()
+            completed = r['cancelled'] or (now - r['created_at'] >= self.config.run_duration)
+            if r['cancelled']:
+                conclusion = 'cancelled'
+            elif completed:
+                conclusion = r['conclusion']
+            else:
+                conclusion = None
+
+            return {
+                'id': run_id,
+                'html_url': '%s/runs/%d' % (base_url, run_id),
+                'display_title': r['display_title'],
+                'event': 'repository_dispatch',
+                'status': 'completed' if completed else 'in_progress',
+                'conclusion': conclusion,
+                'created_at': _iso8601(r['created_at']),
+                'run_started_at': _iso8601(r['created_at']),
+                'updated_at': _iso8601(max(now, r['created_at'] + self.config.run_duration) if completed else now),
+            }
+
+    def artifacts(self, run_id, base_url):
+        with self.lock:
+            r = self.runs.get(run_id)
+        if not r:
+            return None
+
+        names = ['metadata', 'source builddir', 'source packages', 'x86_64 builddir']
+        if r['conclusion'] == 'success':
+            names.append('x86_64 packages')
+
+        return [{'name': n, 'archive_download_url': '%s/artifacts/%d/%s/zip' % (base_url, run_id, urllib.parse.quote(n))}
+                for n in names]
+
+    def artifact_zip(self, run_id, name):
+        with self.lock:
+            r = self.runs.get(run_id)
+        if not r:
+            return None
+
+        p = r['client_payload']
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_STORED) as z:
+            if name == 'metadata':
+                tokens = p.get('DEFAULT_TOKENS', '')
+                z.writestr('scallywag.json', json.dumps({
+                    'BUILDNUMBER': p.get('BUILDNUMBER'),
+                    'PACKAGE': p.get('PACKAGE'),
+                    'COMMIT': p.get('COMMIT'),
+                    'ARCH': 'source',
+                    'MAINTAINER': p.get('MAINTAINER'),
+                    'REFERENCE': p.get('REFERENCE'),
+                    'TOKENS': tokens,
+                    'ANNOUNCE': '',
+                }))
+            elif name.endswith('packages'):
+                arch = name.split()[0]
+                package = p.get('PACKAGE', 'unknown')
+                suffix = '-src' if arch == 'source' else ''
+                z.writestr('%s/%s-1.0-1%s.tar.xz' % (package, package, suffix), self.payload())
+                z.writestr('%s/%s-1.0-1%s.hint' % (package, package, suffix), 'sdesc: "%s"\n' % package)
+            else:
+                z.writestr('builddir.tar.xz', b'')
+
+        return buf.getvalue()
+
+    def logs_zip(self, run_id):
+        with self.lock:
+            r = self.runs.get(run_id)
+        if not r:
+            return None
+
+        p = r['client_payload']
+        stamp = _iso8601(r['created_at']).replace('Z', '.0000000Z')
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+            for i, arch in enumerate(['source', 'x86_64']):
+                lines = ['Building %s for %s' % (p.get('PACKAGE', 'unknown'), arch),
+                         'gcc -c -o foo.o foo.c',
+                         'linking...']
+                if r['conclusion'] == 'failure' and arch != 'source':
+                    lines.append("foo.o: undefined reference to `bar'")
+                    lines.append('collect2: error: ld returned 1 exit status')
+                text = ''.join('%s %s\n' % (stamp, l) for l in lines)
+                z.writestr('%d_%s _ build.txt' % (i, arch), text)
+                z.writestr('%s _ build/1_Build packages.txt' % arch, text)
+
+        return buf.getvalue()
+
+    def cancel(self, run_id):
+        with self.lock:
+            r = self.runs.get(run_id)
+            if not r:
+                return False
+            r['cancelled'] = True
+            return True
+
+
+def workflow_run_event(state, run_id, base_url):
+    # the body of the webhook delivery GitHub sends when a run completes
+    return {
+        'action': 'completed',
+        'repository': {'full_name': 'cygwin/scallywag'},
+        'workflow_run': state.run(run_id, base_url),
+    }
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug('fakegh: ' + format % args)
+
+    def _reply(self, status, body=None, content_type='application/json'):
+        if body is None:
+            data = b''
+        elif isinstance(body, bytes):
+            data = body
+        else:
+            data = json.dumps(body).encode()
+
+        state = self.server.state
+        self.send_response(status)
+        self.send_header('X-RateLimit-Limit', str(state.config.ratelimit))
+        self.send_header('X-RateLimit-Remaining', str(max(state.config.ratelimit - state.ratelimit_used, 0)))
+        self.send_header('X-RateLimit-Reset', str(state.ratelimit_reset))
+        if data:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _prologue(self):
+        state = self.server.state
+        config = state.config
+
+        if config.latency:
+            time.sleep(random.expovariate(1.0 / config.latency))
+
+        with state.lock:
+            state.requests += 1
+            if time.time() >= state.ratelimit_reset:
+                state.ratelimit_reset = int(time.time()) + 3600
+                state.ratelimit_used = 0
+            state.ratelimit_used += 1
+
+        if random.random() < config.failure_rate:
+            with state.lock:
+                state.failures += 1
+            self._reply(500, {'message': 'injected failure'})
+            return False
+
+        return True
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode())
+
+    def do_GET(self):
+        if not self._prologue():
+            return
+
+        state = self.server.state
+        base_url = self.server.url
+        url = urllib.parse.urlparse(self.path)
+        qs = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/app/installations':
+            return self._reply(200, [{'account': {'login': 'cygwin'},
+                                      'access_tokens_url': base_url + '/app/installations/1/access_tokens'}])
+
+        m = re.match(r'^/repos/[^/]+/scallywag/actions/runs$', url.path)
+        if m:
+            per_page = int(qs.get('per_page', ['30'])[0])
+            with state.lock:
+                ids = sorted(state.runs, reverse=True)[:per_page]
+            return self._reply(200, {'total_count': len(state.runs),
+                                     'workflow_runs': [state.run(i, base_url) for i in ids]})
+
+        m = re.match(r'^/repos/[^/]+/scallywag/actions/runs/(\d+)$', url.path)
+        if m:
+            run = state.run(int(m.group(1)), base_url)
+            if not run:
+                return self._reply(404, {'message': 'Not Found'})
+            return self._reply(200, run)
+
+        m = re.match(r'^/repos/[^/]+/scallywag/actions/runs/(\d+)/artifacts$', url.path)
+        if m:
+            artifacts = state.artifacts(int(m.group(1)), base_url)
+            if artifacts is None:
+                return self._reply(404, {'message': 'Not Found'})
+            return self._reply(200, {'total_count': len(artifacts), 'artifacts': artifacts})
+
+        m = re.match(r'^/repos/[^/]+/scallywag/actions/runs/(\d+)/logs$', url.path)
+        if m:
+            data = state.logs_zip(int(m.group(1)))
+            if data is None:
+                return self._reply(404, {'message': 'Not Found'})
+            return self._reply(200, data, content_type='application/zip')
+
+        m = re.match(r'^/artifacts/(\d+)/([^/]+)/zip$', url.path)
+        if m:
+            data = state.artifact_zip(int(m.group(1)), urllib.parse.unquote(m.group(2)))
+            if data is None:
+                return self._reply(404, {'message': 'Not Found'})
+            return self._reply(200, data, content_type='application/zip')
+
+        self._reply(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        body = self._body()
+        if not self._prologue():
+            return
+
+        state = self.server.state
+        url = urllib.parse.urlparse(self.path)
+
+        if url.path == '/app/installations/1/access_tokens':
+            return self._reply(201, {'token': 'fake-installation-token'})
+
+        m = re.match(r'^/repos/[^/]+/scallywag/dispatches$', url.path)
+        if m:
+            state.dispatch(body)
+            return self._reply(204)
+
+        m = re.match(r'^/repos/[^/]+/scallywag/actions/runs/(\d+)/cancel$', url.path)
+        if m:
+            if state.cancel(int(m.group(1))):
+                return self._reply(202, {})
+            return self._reply(404, {'message': 'Not Found'})
+
+        self._reply(404, {'message': 'Not Found'})
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def start(port=0, config=None):
+    # start the server in a background thread, returning it
+    server = Server(('127.0.0.1', port), Handler)
+    server.state = State(config or Config())
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='fake GitHub REST API server')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response latency (seconds)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests which fail')
+    parser.add_argument('--artifact-size', type=int, default=64 * 1024, help='size of package files (bytes)')
+    parser.add_argument('--run-duration', type=float, default=0.0, help='time until runs complete (seconds)')
+    parser.add_argument('--ratelimit', type=int, default=5000, help='requests allowed per hour')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.DEBUG)
+
+    server = Server(('127.0.0.1', args.port), Handler)
+    server.state = State(Config(args.latency, args.failure_rate, args.artifact_size, args.run_duration, ratelimit=args.ratelimit))
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    print('fake GitHub API listening on %s' % server.url)
+    server.serve_forever()
@@ -2,7 +2,15 @@
 #
 # fetch and deploy build artifacts
 #
+# Artifacts of successful builds which aren't deployed automatically (without
+# the 'deploy' token) are prefetched in the background, into a cache, so that a
+# later 'jobs deploy' doesn't have to wait for them to download (or find they
+# have expired in the meantime).  The cache is bounded, and the artifacts of the
+# oldest builds are evicted first.
+#
 
+import contextlib
+import glob
 import logging
 import logging.handlers
 import os
@@ -11,120 +19,386 @@ import shutil
 import socket
 import sqlite3
 import subprocess
-import tempfile
+import threading
+import time
 import urllib.request
 
+import backends
 import carpetbag
-import gh
+import cas
+import deploy
 import gh_token
+import metrics
 
 
-def fetch():
-    incomplete = False
-    trigger = False
+# the most space prefetched artifacts can take up
+cache_max_bytes = 4 * 1024 * 1024 * 1024
 
-    with sqlite3.connect(carpetbag.dbfile) as conn:
-        c = conn.execute("SELECT id, user, arches, artifacts, backend FROM jobs WHERE status = 'fetching'")
+# builds older than this aren't prefetched
+prefetch_max_age = 7 * 24 * 60 * 60
 
-        rows = c.fetchall()
+# how often to look for builds to prefetch
+prefetch_interval = 60
 
-        if len(rows) > 0:
-            logging.info('%d rows ready for fetching' % len(rows))
+# jobs this process has prefetched (or tried to), so ones which failed or have
+# been evicted aren't fetched over and over
+_prefetched = set()
 
-        for r in rows:
-            buildid = r[0]
-            user = r[1]
-            backend = r[4]
-            for arch, art in zip(r[2].split(), r[3].split()):
-                with tempfile.NamedTemporaryFile(delete=False) as tmpfile:
-                    if arch == 'source':
-                        arch = 'src'
-                    # fetch artifact to a tempfile
-                    if art.startswith('http'):
-                        url = art
+
+def cachedir():
+    return os.path.join(carpetbag.stagingroot, 'staging', 'cache')
+
+
+def _cached(buildid, arch):
+    return os.path.join(cachedir(), '%d-%s.zip' % (buildid, arch))
+
+
+def _artifact_url(art):
+    if art.startswith('http'):
+        return art
+    return 'https://ci.appveyor.com/api/buildjobs/%s/artifacts/artifacts.zip' % (art)
+
+
+def _download(url, backend, fn):
+    # fetch artifact to fn, returning True if successful
+    req = urllib.request.Request(url)
+
+    if backend == 'github':
+        req.add_unredirected_header('Authorization', 'Bearer ' + gh_token.fetch_iat())
+
+    logging.info('fetching %s to %s' % (url, fn))
+
+    start = time.time()
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response, open(fn + '.part', 'wb') as f:
+            shutil.copyfileobj(response, f)
+            size = f.tell()
+    except (socket.timeout, urllib.error.URLError) as e:
+        logging.info("archive download response %s" % e)
+        metrics.inc('scallywag_fetch_errors_total', backend=backend,
+                    help='Artifact downloads which failed')
+        return False
+
+    os.replace(fn + '.part', fn)
+
+    metrics.observe('scallywag_fetch_seconds', time.time() - start, backend=backend,
+                    help='Time taken to download an artifact')
+    metrics.inc('scallywag_fetch_bytes_total', size, backend=backend,
+                help='Bytes of artifacts downloaded')
+    return True
+
+
+def _extract(fn, dest):
+    # unpack fn to dest, returning True if successful
+    shutil.rmtree(dest, ignore_errors=True)
+    os.makedirs(dest)
+
+    logging.info('unpacking to %s' % dest)
+    with metrics.timer('scallywag_unpack_seconds', help='Time taken to unpack an artifact'):
+        r = subprocess.run(['unzip', '-o', fn, '-d', dest],
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+
+    for l in r.stdout.decode('utf-8').splitlines():
+        logging.info('unzip: %s' % l)
+
+    if r.returncode != 0:
+        return False
+
+    # deduplicate against identical files previously staged
+    cas.add_tree(dest)
+
+    # mark as ready for calm
+    pathlib.Path(dest, '!ready').touch()
+    return True
+
+
+def _stage(dest, staging):
+    # move to staging area
+    #
+    # (Making all the files appear atomically ensures that the !ready marker
+    # file appears synchronously with the directory.
+    #
+    # That greatly simplifies watching for changes on the staging directory -
+    # otherwise we would need to allow for the delay in establishing watches on
+    # the subdirectories to notice the marker file being created)
+    #
+    # If dest has gone, it was moved before we could record that (and calm may
+    # have since consumed it), so there's nothing to do.
+    if not os.path.isdir(dest):
+        return
+
+    if os.path.exists(os.path.join(staging, '!ready')):
+        # already staged
+        shutil.rmtree(dest)
+        return
+
+    # anything else there is left over from a failed attempt
+    shutil.rmtree(staging, ignore_errors=True)
+
+    logging.info('moving to %s' % staging)
+    os.makedirs(os.path.dirname(staging), exist_ok=True)
+    os.rename(dest, staging)
+
+
+def _checkpoint(conn, buildid, arch, state):
+    with conn:
+        if state:
+            conn.execute('INSERT OR REPLACE INTO fetches (job_id, arch, state, timestamp) VALUES (?, ?, ?, ?)',
+                         (buildid, arch, state, time.time()))
+        else:
+            conn.execute('DELETE FROM fetches WHERE job_id = ? AND arch = ?', (buildid, arch))
+
+
+# jobs claimed at once
+claim_batch = 10
+
+
+# yields the given columns of each job in status which is due an attempt,
+# claiming them a batch at a time (see carpetbag.claim()), and releasing each
+# once it's been processed
+def _claimed(conn, status, columns):
+    last = 0
+    while True:
+        jobids = carpetbag.claim(conn, status, last, claim_batch)
+        if not jobids:
+            return
+
+        logging.info('claimed %d jobs for %s' % (len(jobids), status))
+        try:
+            for jobid in jobids:
+                row = conn.execute('SELECT %s FROM jobs WHERE id = ?' % columns, (jobid,)).fetchone()
+                yield row
+                carpetbag.release(conn, [jobid])
+        finally:
+            # (if we're stopped part way through the batch)
+            carpetbag.release(conn, jobids)
+
+        last = jobids[-1]
+
+
+# The progress of fetching each arch of a job is recorded in the fetches table
+# (downloaded, extracted, staged), so that after a failure, only what's left to
+# do is done on the next attempt (see carpetbag.retry_later()).  Once every arch
+# is staged, the job moves to deploying.
+def fetch():
+    incomplete = False
+    trigger = False
+
+    tmpdir = os.path.join(carpetbag.stagingroot, 'staging', 'tmp')
+    os.makedirs(tmpdir, exist_ok=True)
+
+    conn = sqlite3.connect(carpetbag.dbfile, timeout=30)
+    for r in _claimed(conn, 'fetching', 'id, user, arches, artifacts, backend'):
+        buildid = r[0]
+        user = r[1]
+        backend = r[4]
+        states = dict(conn.execute('SELECT arch, state FROM fetches WHERE job_id = ?', (buildid,)).fetchall())
+
+        # (if it's being deployed again, after calm failed to deploy it)
+        deploy.clear_errors(buildid)
+
+        staged = 0
+        failed = False
+        arches = list(zip(r[2].split(), r[3].split()))
+        for arch, art in arches:
+            if arch == 'source':
+                arch = 'src'
+
+            url = _artifact_url(art)
+            zipfn = os.path.join(tmpdir, '%d-%s.zip' % (buildid, arch))
+            dest = os.path.join(tmpdir, '%d-%s' % (buildid, arch))
+            staging = os.path.join(carpetbag.stagingroot, 'staging', str(buildid), user, arch, 'release')
+
+            state = states.get(arch)
+            if state:
+                logging.info('job %d: %s already %s' % (buildid, arch, state))
+
+            # (download again if the download has gone missing)
+            if state is None or (state == 'downloaded' and not os.path.exists(zipfn)):
+                if not _from_cache(conn, buildid, arch, zipfn) and not _download(url, backend, zipfn):
+                    failed = True
+                    continue
+                state = 'downloaded'
+                _checkpoint(conn, buildid, arch, state)
+
+            if state == 'downloaded':
+                if not _extract(zipfn, dest):
+                    # probably a damaged download, so start again next time
+                    shutil.rmtree(dest, ignore_errors=True)
+                    os.remove(zipfn)
+                    _checkpoint(conn, buildid, arch, None)
+                    failed = True
+                    continue
+                state = 'extracted'
+                _checkpoint(conn, buildid, arch, state)
+                os.remove(zipfn)
+
+            if state == 'extracted':
+                _stage(dest, staging)
+                state = 'staged'
+                _checkpoint(conn, buildid, arch, state)
+                trigger = True
+
+            staged += 1
+
+        # update status to deploying, once every arch is staged
+        if staged == len(arches):
+            with conn:
+                carpetbag.transition(conn, buildid, 'deploying')
+                conn.execute('DELETE FROM fetches WHERE job_id = ?', (buildid,))
+        elif failed:
+            incomplete = True
+            with conn:
+                errored = carpetbag.retry_later(conn, buildid, 'fetching')
+                if errored:
+                    conn.execute('DELETE FROM fetches WHERE job_id = ?', (buildid,))
+
+            # discard any partial progress
+            if errored:
+                metrics.inc('scallywag_errored_total', stage='fetching', help='Jobs given up on')
+                for fn in glob.glob(os.path.join(tmpdir, '%d-*' % buildid)):
+                    if os.path.isdir(fn):
+                        shutil.rmtree(fn, ignore_errors=True)
                     else:
-                        url = 'https://ci.appveyor.com/api/buildjobs/%s/artifacts/artifacts.zip' % (art)
-
-                    req = urllib.request.Request(url)
-
-                    if backend == 'github':
-                        req.add_unredirected_header('Authorization', 'Bearer ' + gh_token.fetch_iat())
-
-                    logging.info('fetching %s to %s' % (url, tmpfile.name))
-
-                    try:
-                        with urllib.request.urlopen(req, timeout=60) as response:
-                            shutil.copyfileobj(response, tmpfile)
-                    except (socket.timeout, urllib.error.URLError) as e:
-                        logging.info("archive download response %s" % e)
-                        incomplete = True
-                        break
-
-                # context exit implicitly closes tmpfile
-
-                # unpack to temporary directory
-                tmpdir = '/sourceware/cygwin-staging/staging/tmp/'
-                os.makedirs(tmpdir, exist_ok=True)
-                dest = tempfile.mkdtemp(dir=tmpdir)
-
-                logging.info('unpacking to %s' % dest)
-                r = subprocess.run(['unzip', '-o', tmpfile.name, '-d', dest],
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-
-                for l in r.stdout.decode('utf-8').splitlines():
-                    logging.info('unzip: %s' % l)
-
-                # mark as ready for calm
-                if r.returncode == 0:
-                    pathlib.Path(dest, '!ready').touch()
-                    trigger = True
-
-                # move to staging area
-                #
-                # (Making all the files appear atomically ensures that the
-                # !ready marker file appears synchronously with the directory.
-                #
-                # That greatly simplifies watching for changes on the staging
-                # directory - otherwise we would need to allow for the delay in
-                # establishing watches on the subdirectories to notice the
-                # marker file being created)
-                staging = '/sourceware/cygwin-staging/staging/%s/%s/%s/release' % (buildid, user, arch)
-                logging.info('moving to %s' % staging)
-                os.makedirs(staging, exist_ok=True)
-                os.rename(dest, staging)
-
-                # remove tmpfile
-                os.remove(tmpfile.name)
-
-                # update status to deployed
-                conn.execute("UPDATE jobs SET status = 'deploying' WHERE id = ?", (buildid,))
+                        os.remove(fn)
 
     conn.close()
 
-    # wake calm to process staging
+    # wake calm to process staging (soon, see deploy.py)
     if trigger:
-        pathlib.Path('/sourceware/cygwin-staging/staging/', '.touch').touch()
+        deploy.request_wake()
 
     return incomplete
 
 
-def fetch_metadata():
-    incomplete = False
+def _from_cache(conn, buildid, arch, fn):
+    # move the prefetched artifact to fn, returning True if there was one
+    try:
+        os.rename(_cached(buildid, arch), fn)
+        hit = True
+    except FileNotFoundError:
+        hit = False
+
+    # (only jobs which waited to be deployed could have been prefetched, so
+    # only count those which were deployed from 'build succeeded', not those
+    # deployed automatically, or deployed again after failing)
+    row = conn.execute("SELECT status FROM transitions WHERE job_id = ? AND "
+                       "rowid < (SELECT MAX(rowid) FROM transitions WHERE job_id = ? AND status = 'fetching') "
+                       "ORDER BY rowid DESC LIMIT 1", (buildid, buildid)).fetchone()
+    if row and row[0] == 'build succeeded':
+        logging.info('job %d: %s %s prefetched' % (buildid, arch, 'was' if hit else "wasn't"))
+        metrics.inc('scallywag_prefetch_lookups_total', result='hit' if hit else 'miss',
+                    help='Artifact fetches of builds deployed on request, by whether they were prefetched')
+    return hit
+
+
+def _evict(conn):
+    # remove cache entries for jobs which are no longer waiting to be deployed,
+    # then those of the oldest jobs, until the cache fits in cache_max_bytes
+    wanted = {r[0] for r in conn.execute("SELECT id FROM jobs WHERE status IN ('build succeeded', 'fetching')")}
+
+    # partial downloads are left behind by a download which failed, or was
+    # interrupted (prefetching is done by a single thread, which isn't
+    # downloading anything while this runs)
+    for fn in glob.glob(os.path.join(cachedir(), '*.zip.part')):
+        logging.info('removing partial download %s from prefetch cache' % fn)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(fn)
+
+    entries = []
+    for fn in glob.glob(os.path.join(cachedir(), '*.zip')):
+        buildid = int(os.path.basename(fn).split('-')[0])
+        try:
+            size = os.path.getsize(fn)
+        except FileNotFoundError:
+            continue
+        entries.append((buildid in wanted, buildid, size, fn))
+
+    total = sum(e[2] for e in entries)
+    for (keep, _, size, fn) in sorted(entries):
+        if keep and total <= cache_max_bytes:
+            break
+
+        logging.info('evicting %s from prefetch cache' % fn)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(fn)
+        total -= size
+        metrics.inc('scallywag_prefetch_evictions_total', help='Prefetched artifacts evicted from the cache')
+
+
+def _busy(conn):
+    # are there artifacts or metadata waiting to be fetched for real?
+    return conn.execute("SELECT 1 FROM jobs WHERE status IN ('fetching metadata', 'fetching') AND next_attempt_at <= ? LIMIT 1",
+                        (time.time(),)).fetchone()
+
+
+def prefetch():
+    os.makedirs(cachedir(), exist_ok=True)
+
+    conn = sqlite3.connect(carpetbag.dbfile, timeout=30)
+    c = conn.execute("SELECT id, arches, artifacts, backend FROM jobs WHERE status = 'build succeeded' AND artifacts IS NOT NULL "
+                     "AND ref IN ('refs/heads/master', 'refs/heads/main') AND srcpkg != 'playground' AND timestamp >= ? ORDER BY id DESC",
+                     (time.time() - prefetch_max_age,))
+    for (buildid, arches, artifacts, backend) in c.fetchall():
+        if buildid in _prefetched:
+            continue
+
+        for arch, art in zip(arches.split(), artifacts.split()):
+            if arch == 'source':
+                arch = 'src'
+
+            # prefetching is low priority, so give way to real fetches
+            if _busy(conn):
+                conn.close()
+                return
+
+            fn = _cached(buildid, arch)
+            if os.path.exists(fn):
+                continue
+
+            if not _download(_artifact_url(art), backend, fn):
+                break
+            metrics.inc('scallywag_prefetches_total', help='Artifacts prefetched')
+
+            # if that was evicted straight away, the cache is full of the
+            # artifacts of newer builds, so there's no point going on
+            _evict(conn)
+            if not os.path.exists(fn):
+                conn.close()
+                return
 
-    with sqlite3.connect(carpetbag.dbfile) as conn:
-        c = conn.execute("SELECT id, backend, backend_id FROM jobs WHERE status = 'fetching metadata'")
-        rows = c.fetchall()
+        _prefetched.add(buildid)
 
-        if len(rows) > 0:
-            logging.info('%d rows ready for fetching metadata' % len(rows))
+    _evict(conn)
+    conn.close()
+
+
+def prefetcher():
+    # prefetch in a thread of its own, so downloads don't hold up the daemon
+    def run():
+        while True:
+            try:
+                prefetch()
+            except (sqlite3.Error, OSError) as e:
+                logging.error('prefetching failed: %s' % e)
+            time.sleep(prefetch_interval)
+
+    t = threading.Thread(target=run, name='prefetch', daemon=True)
+    t.start()
+    return t
+
+
+def fetch_metadata():
+    incomplete = False
 
-        for r in rows:
+    with sqlite3.connect(carpetbag.dbfile, timeout=30) as conn:
+        for r in _claimed(conn, 'fetching metadata', 'id, backend, backend_id'):
             buildid = r[0]
-            backend = r[1]
+            backend = backends.lookup_by_name(r[1])
             backend_id = r[2]
 
-            if backend != 'github':
+            if not hasattr(backend, 'examine_artifacts'):
                 continue
 
             u = carpetbag.Update()
@@ -132,27 +406,34 @@ def fetch_metadata():
             u.buildnumber = buildid
             u.backend_id = backend_id
 
-            if gh.examine_run_artifacts(backend_id, u):
+            if backend.examine_artifacts(backend_id, u):
+                metrics.inc('scallywag_metadata_fetches_total', result='ok', help='Attempts to fetch build metadata')
                 carpetbag.update_metadata(u)
             else:
+                metrics.inc('scallywag_metadata_fetches_total', result='retry', help='Attempts to fetch build metadata')
                 logging.info("fetching metadata for %s failed, will retry later" % buildid)
-                # if examine_run_artifacts fails, we'll try again later
+                # if examine_artifacts fails, we'll try again later
                 incomplete = True
 
-                # XXX: if the metadata file doesn't appear even after a long
-                # time after the wfr finished, that that suggests something went
-                # wrong in internally in scallywag, before it writes it, in
-                # which case we should change the status to errored
+                # if the metadata file doesn't appear even after a long time
+                # after the wfr finished, that suggests something went wrong
+                # internally in scallywag, before it writes it, so eventually
+                # the job is errored
+                with conn:
+                    if carpetbag.retry_later(conn, buildid, 'fetching metadata'):
+                        metrics.inc('scallywag_errored_total', stage='fetching metadata', help='Jobs given up on')
 
     conn.close()
 
     return incomplete
 
 
-def process():
+def process(gc=True):
     try:
         incomplete = fetch_metadata()
         incomplete = fetch() or incomplete
+        if gc:
+            cas.gc()
     except sqlite3.OperationalError as e:
         logging.error(e)
         incomplete = True
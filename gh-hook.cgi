@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
-import cgitb
 import hashlib
 import hmac
 import json
 import os
 import sys
+import time
 import traceback
 
 import carpetbag
@@ -13,12 +13,17 @@ import gh
 
 
 basedir = os.path.dirname(os.path.realpath(__file__))
-secretfile = os.path.join(basedir, 'secret')
+# where the webhook secret is kept, and last.json is written
+statedir = os.environ.get('SCALLYWAG_HOOK_DIR', basedir)
+secretfile = os.path.join(statedir, 'secret')
+# if this directory exists, every delivery is also saved there, for replaying
+# with hookreplay
+recorddir = os.path.join(statedir, 'deliveries')
 
 
 def process(data):
     j = json.loads(data)
-    with open(os.path.join(basedir, 'last.json'), 'w') as f:
+    with open(os.path.join(statedir, 'last.json'), 'w') as f:
         print(json.dumps(j, sort_keys=True, indent=4), file=f)
 
     # XXX: also handle 'requested', 'in_progress'
@@ -33,39 +38,49 @@ def process(data):
     if not wfr:
         return None
 
-    return gh._process_wfr(wfr)
+    return gh.process_wfr(wfr)
 
 
 def hook():
     if os.environ['REQUEST_METHOD'] != 'POST':
         return '400 Bad Request', ''
 
+    data = sys.stdin.read()
+
+    return handle(data, os.environ.get('HTTP_X_HUB_SIGNATURE_256', ''))
+
+
+def handle(data, trysig):
     if not os.path.exists(secretfile):
         return '401 Unauthorized', ''
     with open(secretfile) as f:
         secret = f.read().strip()
 
-    data = sys.stdin.read()
-
     sig = 'sha256=' + hmac.new(secret.encode(), data.encode(),
                                hashlib.sha256).hexdigest()
-    trysig = os.environ.get('HTTP_X_HUB_SIGNATURE_256', '')
     if trysig != sig:
         return '401 Unauthorized', ''
 
-    u = process(data)
-    if u:
-        # ensure backend_id is set, if it was previously unknown due to timeout waiting for it to be assigned
-        if hasattr(u, 'buildnumber'):
-            carpetbag.update_backend_id(u)
+    record(data)
 
+    u = process(data)
+    if u and hasattr(u, 'buildnumber'):
         carpetbag.update_status(u)
 
     return '200 OK', ''
 
 
+def record(data):
+    if not os.path.isdir(recorddir):
+        return
+
+    fn = os.path.join(recorddir, '%d.json' % time.time_ns())
+    with open(fn, 'w') as f:
+        f.write(data)
+
+
 def test():
-    with open(os.path.join(basedir, 'last.json')) as f:
+    with open(os.path.join(statedir, 'last.json')) as f:
         data = f.read()
     u = process(data)
     if u:
@@ -73,7 +88,6 @@ def test():
 
 
 if __name__ == '__main__':
-    cgitb.enable()
     try:
         status, content = hook()
         print('Status: %s' % status)
@@ -83,6 +97,10 @@ if __name__ == '__main__':
         # log exception to stderr
         traceback.print_exc()
         # allow cgitb to do it's thing
+        #
+        # (cgitb is slow to import, so only when it's needed)
+        import cgitb
+        cgitb.enable()
         print('Content-Type: text/plain')
         print('Status: 422')
         print()
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 
-import contextlib
-import fcntl
+import calendar
 import json
 import logging
 import os
 import re
 import shutil
 import tempfile
+import threading
 import time
 import urllib.error
 import urllib.request
@@ -15,12 +15,14 @@ import zipfile
 
 import carpetbag
 import gh_token
+import metrics
+import utils
 
 
 class Backend():
     @staticmethod
     def cancel_build(bbid):
-        _github_workflow_cancel(bbid)
+        return _github_workflow_cancel(bbid)
 
     @staticmethod
     def request_build(package, maintainer, commit, reference, default_tokens, buildnumber):
@@ -32,20 +34,90 @@ class Backend():
     def check_build_status(bbid):
         return _github_check_status(bbid)
 
+    @staticmethod
+    def examine_artifacts(bbid, u):
+        return examine_run_artifacts(bbid, u)
+
+    @staticmethod
+    def throttle():
+        return ratelimit_wait()
+
 
-@contextlib.contextmanager
 def locked():
-    old_umask = os.umask(0o000)
-    lockfile = open('/tmp/scallywag.request_build.lock', 'w+')
-    os.umask(old_umask)
-    fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
-    logging.info("acquired request_build lock")
+    return utils.locked('/tmp/scallywag.request_build.lock')
+
+
+# the rate limit state of the API, as of the most recent response
+ratelimit = {'remaining': None, 'reset': None}
+ratelimit_lock = threading.Lock()
+
+# requests to keep in reserve for the daemon and webhook, which aren't
+# deferrable
+ratelimit_reserve = 100
+# the longest we'll wait for the rate limit to reset
+ratelimit_max_wait = 300
+
+
+def _record_ratelimit(response):
+    headers = getattr(response, 'headers', None)
+    if not headers:
+        return
+
+    with ratelimit_lock:
+        if headers.get('X-RateLimit-Remaining') is not None:
+            ratelimit['remaining'] = int(headers['X-RateLimit-Remaining'])
+            ratelimit['reset'] = int(headers.get('X-RateLimit-Reset', 0))
+
+        # a secondary rate limit says how long to back off for
+        if headers.get('Retry-After') is not None:
+            ratelimit['remaining'] = 0
+            ratelimit['reset'] = time.time() + int(headers['Retry-After'])
+
+
+# wait, if needed, until the rate limit allows us to make deferrable requests.
+# Returns False if that would be longer than ratelimit_max_wait.
+def ratelimit_wait():
+    with ratelimit_lock:
+        remaining = ratelimit['remaining']
+        reset = ratelimit['reset']
+
+    if remaining is None or remaining >= ratelimit_reserve:
+        return True
+
+    wait = (reset or 0) - time.time()
+    if wait > ratelimit_max_wait:
+        logging.warning('rate limited, %d requests remaining until %s' % (remaining, time.ctime(reset)))
+        return False
+
+    if wait > 0:
+        logging.info('rate limited, waiting %ds' % wait)
+        time.sleep(wait)
+
+    with ratelimit_lock:
+        if ratelimit['reset'] == reset:
+            ratelimit['remaining'] = None
+
+    return True
+
+
+# make a GitHub REST API request, recording it's latency and outcome
+def _urlopen(req, endpoint, data=None):
+    start = time.time()
     try:
-        yield lockfile
-    finally:
-        logging.info("releasing request_build lock")
-        fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
-        lockfile.close()
+        response = urllib.request.urlopen(req, data=data)
+        status = response.getcode()
+    except urllib.error.URLError as e:
+        response = e
+        status = getattr(e, 'code', 'error')
+
+    _record_ratelimit(response)
+
+    metrics.observe('scallywag_github_api_request_seconds', time.time() - start, endpoint=endpoint,
+                    help='Latency of GitHub REST API requests')
+    metrics.inc('scallywag_github_api_requests_total', endpoint=endpoint, status=status,
+                help='GitHub REST API requests, by response status')
+
+    return response
 
 
 def _github_most_recent_wfr_id():
@@ -57,14 +129,11 @@ def _github_most_recent_wfr_id():
     qs = urllib.parse.urlencode(data)
 
     (owner, token) = gh_token.fetch_auth()
-    req = urllib.request.Request('https://api.github.com/repos/%s/scallywag/actions/runs?%s' % (owner, qs))
+    req = urllib.request.Request('%s/repos/%s/scallywag/actions/runs?%s' % (gh_token.api_url, owner, qs))
     req.add_header('Accept', 'application/vnd.github.v3+json')
     req.add_header('Authorization', 'Bearer ' + token)
 
-    try:
-        response = urllib.request.urlopen(req)
-    except urllib.error.URLError as e:
-        response = e
+    response = _urlopen(req, 'runs')
 
     status = response.getcode()
     logging.info("runs REST API status %s" % status)
@@ -115,15 +184,12 @@ def _github_workflow_trigger(package, maintainer, commit, reference, default_tok
     }
 
     (owner, token) = gh_token.fetch_auth()
-    req = urllib.request.Request('https://api.github.com/repos/%s/scallywag/dispatches' % owner)
+    req = urllib.request.Request('%s/repos/%s/scallywag/dispatches' % (gh_token.api_url, owner))
 
     req.add_header('Accept', 'application/vnd.github.v3+json')
     req.add_header('Authorization', 'Bearer ' + token)
 
-    try:
-        response = urllib.request.urlopen(req, data=json.dumps(data).encode('utf-8'))
-    except urllib.error.URLError as e:
-        response = e
+    response = _urlopen(req, 'dispatches', data=json.dumps(data).encode('utf-8'))
 
     status = response.getcode()
     if status != 204:
@@ -160,32 +226,29 @@ def _github_workflow_trigger(package, maintainer, commit, reference, default_tok
 
 def _github_workflow_cancel(wfr_id):
     (owner, token) = gh_token.fetch_auth()
-    req = urllib.request.Request('https://api.github.com/repos/{}/scallywag/actions/runs/{}/cancel'.format(owner, wfr_id), method='POST')
+    req = urllib.request.Request('{}/repos/{}/scallywag/actions/runs/{}/cancel'.format(gh_token.api_url, owner, wfr_id), method='POST')
 
     req.add_header('Accept', 'application/vnd.github.v3+json')
     req.add_header('Authorization', 'Bearer ' + token)
 
-    try:
-        response = urllib.request.urlopen(req)
-    except urllib.error.URLError as e:
-        response = e
+    response = _urlopen(req, 'cancel')
 
-    status = response.getcode()
+    # (a URLError which isn't an HTTPError has no status, e.g. a timeout)
+    status = getattr(response, 'code', None) if isinstance(response, urllib.error.URLError) else response.getcode()
     if status != 202:
         print('scallywag: GitHub REST API failed status %s' % (status))
+        return False
+    return True
 
 
 def _github_check_status(wfr_id):
     (owner, token) = gh_token.fetch_auth()
-    req = urllib.request.Request('https://api.github.com/repos/{}/scallywag/actions/runs/{}'.format(owner, wfr_id))
+    req = urllib.request.Request('{}/repos/{}/scallywag/actions/runs/{}'.format(gh_token.api_url, owner, wfr_id))
 
     req.add_header('Accept', 'application/vnd.github.v3+json')
     req.add_header('Authorization', 'Bearer ' + token)
 
-    try:
-        response = urllib.request.urlopen(req)
-    except urllib.error.URLError as e:
-        response = e
+    response = _urlopen(req, 'run')
 
     status = response.getcode()
     if status != 200:
@@ -203,6 +266,8 @@ def process_wfr(wfr):
     u.backend_id = wfr['id']
     u.buildurl = wfr['html_url']
     u.duration = parse_iso8601_time(wfr['updated_at']) - parse_iso8601_time(wfr['created_at'])
+    if wfr.get('run_started_at'):
+        u.started = parse_iso8601_time(wfr['run_started_at'])
 
     # extract build_id from the title
     title = wfr['display_title']
@@ -229,20 +294,31 @@ def process_wfr(wfr):
 def parse_iso8601_time(s):
     time_format = '%Y-%m-%dT%H:%M:%SZ'  # e.g. "2021-05-27T20:38:23Z"
     st = time.strptime(s, time_format)
-    t = time.mktime(st)
+    t = calendar.timegm(st)
     return int(t)
 
 
+# read the build metadata from the metadata artifact zipfn into u
+def read_metadata(zipfn, u):
+    with zipfile.ZipFile(zipfn) as z:
+        with z.open('scallywag.json') as m:
+            mj = json.load(m)
+            u.buildnumber = mj['BUILDNUMBER']
+            u.package = mj['PACKAGE']
+            u.commit = mj['COMMIT']
+            u.reference = mj['REFERENCE']
+            u.maintainer = mj['MAINTAINER']
+            u.tokens = mj['TOKENS']
+            u.announce = mj['ANNOUNCE']
+
+
 def examine_run_artifacts(wfr_id, u):
     # Retrieve list of workflow run artifacts
     (owner, token) = gh_token.fetch_auth()
-    req = urllib.request.Request('https://api.github.com/repos/{}/scallywag/actions/runs/{}/artifacts'.format(owner, wfr_id))
+    req = urllib.request.Request('{}/repos/{}/scallywag/actions/runs/{}/artifacts'.format(gh_token.api_url, owner, wfr_id))
     req.add_header('Accept', 'application/vnd.github.v3+json')
 
-    try:
-        response = urllib.request.urlopen(req)
-    except urllib.error.URLError as e:
-        response = e
+    response = _urlopen(req, 'artifacts')
 
     status = response.getcode()
     logging.info("artifacts REST API status %s" % status)
@@ -269,26 +345,16 @@ def examine_run_artifacts(wfr_id, u):
             # list of artifacts. it seems we need to wait a little while after
             # the run has completed before that URL becomes valid, so we'll try
             # again later.
-            try:
-                response = urllib.request.urlopen(req)
-            except urllib.error.URLError as e:
-                logging.info("metadata download REST API response %s" % e)
+            response = _urlopen(req, 'artifact_download')
+            if isinstance(response, urllib.error.URLError):
+                logging.info("metadata download REST API response %s" % response)
                 break
 
             # fetch to a temporary file as zipfile needs to seek
             with tempfile.NamedTemporaryFile(delete=False) as tmpfile:
                 shutil.copyfileobj(response, tmpfile)
 
-            with zipfile.ZipFile(tmpfile.name) as z:
-                with z.open('scallywag.json') as m:
-                    mj = json.load(m)
-                    u.buildnumber = mj['BUILDNUMBER']
-                    u.package = mj['PACKAGE']
-                    u.commit = mj['COMMIT']
-                    u.reference = mj['REFERENCE']
-                    u.maintainer = mj['MAINTAINER']
-                    u.tokens = mj['TOKENS']
-                    u.announce = mj['ANNOUNCE']
+            read_metadata(tmpfile.name, u)
 
             # remove tmpfile
             os.remove(tmpfile.name)
@@ -308,6 +374,46 @@ def examine_run_artifacts(wfr_id, u):
     return found_metadata
 
 
+# download the logs of a workflow run, returning the name of a temporary file
+# containing them (a zip file, with a text file for each job, and a directory
+# for each job containing a text file for each step), False if they no longer
+# exist, or None if they couldn't be downloaded now
+def fetch_run_logs(wfr_id):
+    # (failing to get a token is retried like failing to fetch the logs)
+    try:
+        (owner, token) = gh_token.fetch_auth()
+    except OSError as e:
+        logging.info("logs token fetch failed: %s" % e)
+        return None
+
+    req = urllib.request.Request('{}/repos/{}/scallywag/actions/runs/{}/logs'.format(gh_token.api_url, owner, wfr_id))
+    req.add_header('Accept', 'application/vnd.github.v3+json')
+    # (this redirects to the actual location of the logs, which doesn't want
+    # our credentials)
+    req.add_unredirected_header('Authorization', 'Bearer ' + token)
+
+    response = _urlopen(req, 'logs')
+
+    # (a URLError which isn't an HTTPError has no status, e.g. a timeout)
+    status = getattr(response, 'code', None) if isinstance(response, urllib.error.URLError) else response.getcode()
+    logging.info("logs REST API status %s" % status)
+    if status in [404, 410]:
+        return False
+    if status != 200:
+        return None
+
+    # fetch to a temporary file as zipfile needs to seek
+    with tempfile.NamedTemporaryFile(delete=False) as tmpfile:
+        try:
+            shutil.copyfileobj(response, tmpfile)
+        except OSError as e:
+            logging.info("logs download failed: %s" % e)
+            os.remove(tmpfile.name)
+            return None
+
+    return tmpfile.name
+
+
 if __name__ == '__main__':
     import sys
     import types
@@ -1,35 +1,49 @@
 #!/usr/bin/env python3
 
-# locate imports on sourceware
-import sys
-sys.path.insert(0, '/home/cygwin/.local/lib/python{}.{}/site-packages'.format(sys.version_info.major, sys.version_info.minor))
-
-from cryptography.hazmat.backends import default_backend
 import json
-import jwt
 import os
+import sys
 import time
 import urllib.error
 import urllib.request
 
 GH_APP_ID = 117451
 
+# allow a different API endpoint (e.g. fakegh.py) to be used for testing
+api_url = os.environ.get('SCALLYWAG_GITHUB_API', 'https://api.github.com')
+
 private_key = None
 
 
+# cryptography and jwt are slow to import, and only needed when we need to
+# make a token, so they are imported then
+def _site_packages():
+    # locate imports on sourceware
+    site_packages = '/home/cygwin/.local/lib/python{}.{}/site-packages'.format(sys.version_info.major, sys.version_info.minor)
+    if site_packages not in sys.path:
+        sys.path.insert(0, site_packages)
+
+
 def _get_private_key():
     global private_key
     if not private_key:
+        _site_packages()
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+
         # load the GitHub app private key
         basedir = os.path.dirname(os.path.realpath(__file__))
-        pemfile = os.path.join(basedir, 'scallywag.private-key.pem')
+        pemfile = os.environ.get('SCALLYWAG_PRIVATE_KEY', os.path.join(basedir, 'scallywag.private-key.pem'))
         cert = open(pemfile, 'r').read().encode()
-        private_key = default_backend().load_pem_private_key(cert, None)
+        private_key = serialization.load_pem_private_key(cert, None, default_backend())
 
     return private_key
 
 
 def _make_jwt():
+    _site_packages()
+    import jwt
+
     now = int(time.time())
 
     payload = {
@@ -38,7 +52,7 @@ def _make_jwt():
         # expiration time (10 minute maximum)
         'exp': now + (10 * 60),
         # GitHub App's identifier
-        'iss': GH_APP_ID,
+        'iss': str(GH_APP_ID),
     }
 
     return jwt.encode(payload, _get_private_key(), algorithm='RS256')
@@ -48,7 +62,7 @@ def fetch_iat():
     token = _make_jwt()
 
     # list installations for this app
-    req = urllib.request.Request('https://api.github.com/app/installations')
+    req = urllib.request.Request(api_url + '/app/installations')
     req.add_header('Authorization', 'Bearer {}'.format(token))
     req.add_header('Accept', 'application/vnd.github.v3+json')
     resp = urllib.request.urlopen(req)
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import cgitb
 import json
 import os
 import re
@@ -94,7 +93,6 @@ def hook():
 
 
 if __name__ == '__main__':
-    cgitb.enable()
     try:
         status, content = hook()
         print('Status: %s' % status)
@@ -104,6 +102,10 @@ if __name__ == '__main__':
         # log exception to stderr
         traceback.print_exc()
         # allow cgitb to do it's thing
+        #
+        # (cgitb is slow to import, so only when it's needed)
+        import cgitb
+        cgitb.enable()
         print('Content-Type: text/plain')
         print('Status: 422')
         print()
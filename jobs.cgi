@@ -22,13 +22,16 @@
 #
 
 import cgi
-import cgitb
 import datetime
+import json
+import os
 import sqlite3
 import textwrap
 from urllib.parse import urlencode
 
 import carpetbag
+import durations
+import scheduler
 
 dbfn = carpetbag.dbfile
 rows_per_page = 25
@@ -36,10 +39,59 @@ conn = sqlite3.connect('file:%s?mode=ro' % dbfn, uri=True)
 conn.row_factory = sqlite3.Row
 
 
-def results(parse):
+def query(parse):
+    # returns the table, the page number, the number of pages and the rows of
+    # the page of jobs selected by parse
     page = int(parse.get('page', 1))
     highlight = int(parse.get('id', 0))
 
+    # old jobs are in the archive, which is only consulted if asked for, or
+    # if the job to highlight isn't in the hot table
+    table = 'jobs'
+    if 'archive' in parse or (highlight and not conn.execute('SELECT 1 FROM jobs WHERE id = ?', (highlight,)).fetchone()):
+        table = carpetbag.attach_archive(conn)
+
+    where_list = []
+    where_params = ()
+    for w in ['user', 'status', 'srcpkg']:
+        if w in parse:
+            where_list.append("%s = ?" % (w))
+            where_params = where_params + (parse[w],)
+    where_clause = ''
+    if where_list:
+        where_clause = 'WHERE ' + 'AND '.join(where_list)
+
+    sql = 'SELECT COUNT(*) FROM %s %s' % (table, where_clause)
+    c = conn.execute(sql, where_params)
+    (rows,) = c.fetchone()
+    maxpages = int((rows + (rows_per_page - 1)) / rows_per_page)
+
+    # show the page containing the job to highlight
+    if highlight and 'page' not in parse:
+        sql = 'SELECT COUNT(*) FROM %s %s' % (table, (where_clause + ' AND' if where_clause else 'WHERE') + ' id > ?')
+        (newer,) = conn.execute(sql, where_params + (highlight,)).fetchone()
+        page = newer // rows_per_page + 1
+    if page < 1:
+        page = 1
+    if page > maxpages:
+        page = maxpages
+
+    sql = 'SELECT * FROM %s %s' % (table, where_clause) + ' ORDER BY id DESC LIMIT ?,?'
+    c = conn.execute(sql, where_params + (max(page - 1, 0) * rows_per_page, rows_per_page))
+    return table, page, maxpages, c.fetchall()
+
+
+def eta(row, cache):
+    # the estimated seconds remaining for a running job, and if it's overdue
+    if row['status'] != 'pending':
+        return None, False
+    return durations.progress(conn, row['id'], row['srcpkg'], cache)
+
+
+def results(parse):
+    highlight = int(parse.get('id', 0))
+    table, page, maxpages, rows = query(parse)
+
     result = textwrap.dedent('''\
                              <!DOCTYPE html>
                              <html lang="en">
@@ -64,7 +116,7 @@ def results(parse):
 
     def options_list(column):
         selected = parse.get(column, '')
-        sql = 'SELECT DISTINCT %s FROM jobs ORDER BY %s' % (column, column)
+        sql = 'SELECT DISTINCT %s FROM %s ORDER BY %s' % (column, table, column)
         c = conn.execute(sql)
         opts = [''] + [r[0] for r in c]
         return ('<select name="%s" form="filter">' % (column) +
@@ -84,28 +136,10 @@ def results(parse):
                                                       options_list('status'),
                                                       options_list('user')))
 
-    where_list = []
-    where_params = ()
-    for w in ['user', 'status', 'srcpkg']:
-        if w in parse:
-            where_list.append("%s = ?" % (w))
-            where_params = where_params + (parse[w],)
-    where_clause = ''
-    if where_list:
-        where_clause = 'WHERE ' + 'AND '.join(where_list)
-
-    sql = 'SELECT COUNT(*) FROM jobs %s' % (where_clause)
-    c = conn.execute(sql, where_params)
-    (rows,) = c.fetchone()
-    maxpages = int((rows + (rows_per_page - 1)) / rows_per_page)
-    if page < 1:
-        page = 1
-    if page > maxpages:
-        page = maxpages
+    positions = scheduler.positions(conn)
+    cache = {}
 
-    sql = 'SELECT * FROM jobs %s' % where_clause + 'ORDER BY id DESC LIMIT ?,?'
-    c = conn.execute(sql, where_params + ((page - 1) * rows_per_page, rows_per_page))
-    for row in c:
+    for row in rows:
         jobid = row['id']
         srcpkg = row['srcpkg']
         commit = row['hash']
@@ -117,6 +151,7 @@ def results(parse):
         arches = row['arches']
         # artifacts = row['artifacts']
         ref = row['ref']
+        cached_from = row['cached_from']
 
         commiturl = 'https://cygwin.com/cgit/cygwin-packages/%s/commit/?id=%s' % (srcpkg, commit)
         shorthash = commit[0:8]
@@ -131,10 +166,13 @@ def results(parse):
         else:
             srcpkglink = '%s' % (srcpkg)
 
+        if status == 'queued' and jobid in positions:
+            status = 'queued (%d)' % positions[jobid]
+
         def status_to_class(s):
             if s.endswith('succeeded') or s == 'deployed':
                 return 'succeeded'  # green
-            elif s.endswith('failed'):
+            elif s.endswith('failed') or s == 'errored':
                 return 'failed'   # red
             else:
                 return 'normal'
@@ -152,7 +190,9 @@ def results(parse):
         else:
             result += '<td></td>'
 
-        if logurl:
+        if logurl and cached_from:
+            result += '<td><a href="%s">[log]</a> <a href="?id=%d">[cached]</a></td>' % (logurl, cached_from)
+        elif logurl:
             result += '<td><a href="%s">[log]</a></td>' % (logurl)
         else:
             result += '<td></td>'
@@ -167,8 +207,13 @@ def results(parse):
         else:
             result += '<td></td>'
 
+        remaining, overdue = eta(row, cache)
         if duration:
             result += '<td>%s</td>' % (str(datetime.timedelta(seconds=int(duration))))
+        elif overdue:
+            result += '<td class="failed">overdue</td>'
+        elif remaining is not None:
+            result += '<td>~%s left</td>' % (str(datetime.timedelta(seconds=max(int(remaining), 0) // 60 * 60)))
         else:
             result += '<td></td>'
 
@@ -191,7 +236,10 @@ def results(parse):
     if page < maxpages:
         result += '<a href="?%s">next</a>' % query_string_modify_page(page + 1)
     result += '</span>'
-    result += '<span class="right"></span>'
+    if table == 'jobs' and os.path.exists(carpetbag.archivefile):
+        result += '<span class="right"><a href="?%s">include archived jobs</a></span>' % urlencode(dict(parse, archive=1, page=1))
+    else:
+        result += '<span class="right"></span>'
     result += '</div>'
 
     result += textwrap.dedent('''</body>
@@ -199,15 +247,43 @@ def results(parse):
     return result
 
 
-if __name__ == "__main__":
-    cgitb.enable()
-    print('Content-Type: text/html')
-    print()
+def results_json(parse):
+    table, page, maxpages, rows = query(parse)
+    cache = {}
 
+    jobs = []
+    for row in rows:
+        job = dict(row)
+        job['eta'], job['overdue'] = eta(row, cache)
+        jobs.append(job)
+
+    return json.dumps({'page': page, 'pages': maxpages, 'jobs': jobs})
+
+
+def main():
     parse = cgi.parse()
 
     # if any query variable appears more than once, use the value of the last
     # occurence.
     parse = {k: v[-1] for k, v in parse.items()}
 
-    print(results(parse))
+    if parse.pop('format', None) == 'json':
+        print('Content-Type: application/json')
+        print()
+        print(results_json(parse))
+    else:
+        print('Content-Type: text/html')
+        print()
+        print(results(parse))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception:
+        # allow cgitb to do it's thing
+        #
+        # (cgitb is slow to import, so only when it's needed)
+        import cgitb
+        cgitb.enable()
+        raise
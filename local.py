@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+#
+# a build backend which runs builds as subprocesses on this machine
+#
+# This lets the whole server side (request, pending, completion, metadata,
+# fetch, staging) be exercised, soak tested and profiled offline, on one box.
+#
+# 'local.py serve' runs the build server: a small HTTP API for dispatching and
+# cancelling builds, which runs the build command for each in a pool of workers,
+# serves the artifacts they produce, and reports their completion (as the same
+# Update objects which gh.process_wfr() produces from GitHub's webhook).
+#
+# The build command is run with BUILDNUMBER, PACKAGE, MAINTAINER, COMMIT,
+# REFERENCE and DEFAULT_TOKENS in the environment, and writes each artifact as a
+# subdirectory of the directory named by ARTIFACTS, named like those of the
+# GitHub workflow: 'metadata' containing scallywag.json, and '<arch> packages'.
+# A zero exit status means the build succeeded.  'local.py stub' is a build
+# command which fabricates them.
+#
+# Set SCALLYWAG_BACKEND=local for builds to be requested from the server at
+# SCALLYWAG_LOCAL_URL.
+#
+
+import argparse
+import concurrent.futures
+import http.server
+import json
+import logging
+import os
+import random
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import carpetbag
+
+api_url = os.environ.get('SCALLYWAG_LOCAL_URL', 'http://127.0.0.1:8010')
+workdir = os.environ.get('SCALLYWAG_LOCAL_DIR', os.path.join(carpetbag.stagingroot, 'local'))
+
+
+class Backend():
+    @staticmethod
+    def cancel_build(bbid):
+        return _request('/builds/%d/cancel' % bbid, {}) is not None
+
+    @staticmethod
+    def request_build(package, maintainer, commit, reference, default_tokens, buildnumber):
+        j = _request('/builds', {
+            'BUILDNUMBER': buildnumber,
+            'PACKAGE': package,
+            'MAINTAINER': maintainer,
+            'COMMIT': commit,
+            'REFERENCE': reference,
+            'DEFAULT_TOKENS': default_tokens,
+        })
+        if not j:
+            return -1, None
+        return j['id'], j['html_url']
+
+    @staticmethod
+    def check_build_status(bbid):
+        j = _request('/builds/%d' % bbid)
+        if not j:
+            return None
+        return process_run(j)
+
+    @staticmethod
+    def examine_artifacts(bbid, u):
+        return examine_artifacts(bbid, u)
+
+    @staticmethod
+    def throttle():
+        return True
+
+
+def _request(path, data=None):
+    # returns the decoded JSON response, or None if the request failed
+    req = urllib.request.Request(api_url + path)
+    if data is not None:
+        req.add_header('Content-Type', 'application/json')
+        req.data = json.dumps(data).encode('utf-8')
+
+    try:
+        with urllib.request.urlopen(req, timeout=60) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError) as e:
+        logging.error('local backend %s failed: %s' % (path, e))
+        return None
+
+
+# make an Update from the state of a build, as gh.process_wfr() does from a
+# workflow run
+def process_run(run):
+    u = carpetbag.Update()
+
+    u.backend_id = run['id']
+    u.buildnumber = run['BUILDNUMBER']
+    u.buildurl = run['html_url']
+    u.duration = int(run['updated_at'] - run['created_at'])
+    if run.get('started_at'):
+        u.started = int(run['started_at'])
+
+    conclusion = run['conclusion']
+    if conclusion is None:  # no conclusion => still running
+        u.status = 'pending'
+    elif conclusion == 'success':
+        u.status = 'build succeeded'
+    elif conclusion == 'cancelled':
+        u.status = 'cancelled'
+    else:
+        u.status = 'build failed'
+
+    logging.info('local, backend_id: %d, conclusion: %s -> status: %s' % (u.backend_id, conclusion, u.status))
+
+    return u
+
+
+def examine_artifacts(bbid, u):
+    import gh
+
+    artifacts = _request('/builds/%d/artifacts' % bbid)
+    if artifacts is None:
+        return False
+
+    u.artifacts = {}
+    found_metadata = False
+
+    for a in artifacts:
+        if a['name'] == 'metadata':
+            try:
+                fn, _ = urllib.request.urlretrieve(a['archive_download_url'])
+            except OSError as e:
+                logging.info('metadata download response %s' % e)
+                return False
+            gh.read_metadata(fn, u)
+            os.remove(fn)
+            found_metadata = True
+
+        elif a['name'].endswith('packages'):
+            arch = a['name'][:-len('packages')].strip()
+            u.artifacts[arch] = a['archive_download_url']
+
+    return found_metadata
+
+
+#
+# the build server
+#
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, command, workers):
+        super().__init__(address, Handler)
+        self.url = 'http://%s:%d' % self.server_address
+        self.command = command
+        self.lock = threading.Lock()
+        self.builds = {}
+        self.procs = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        # builds from earlier runs of the server are still available, but any
+        # which were running were lost
+        os.makedirs(os.path.join(workdir, 'builds'), exist_ok=True)
+        for d in os.listdir(os.path.join(workdir, 'builds')):
+            try:
+                with open(os.path.join(workdir, 'builds', d, 'build.json')) as f:
+                    build = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if build['conclusion'] is None:
+                build['status'] = 'completed'
+                build['conclusion'] = 'failure'
+            self.builds[build['id']] = build
+
+    def builddir(self, bbid):
+        return os.path.join(workdir, 'builds', str(bbid))
+
+    def save(self, build):
+        build['updated_at'] = time.time()
+        fn = os.path.join(self.builddir(build['id']), 'build.json')
+        with open(fn + '.tmp', 'w') as f:
+            json.dump(build, f)
+        os.replace(fn + '.tmp', fn)
+
+    def dispatch(self, data):
+        with self.lock:
+            bbid = max(self.builds, default=0) + 1
+            build = dict(data, id=bbid, html_url='%s/builds/%d/log' % (self.url, bbid), created_at=time.time(),
+                         started_at=None, status='queued', conclusion=None, cancelled=False)
+            self.builds[bbid] = build
+            os.makedirs(self.builddir(bbid))
+            self.save(build)
+
+        self.executor.submit(self.run, bbid)
+        return dict(build)
+
+    def cancel(self, bbid):
+        with self.lock:
+            build = self.builds.get(bbid)
+            if not build:
+                return False
+            build['cancelled'] = True
+            p = self.procs.get(bbid)
+        if p:
+            p.terminate()
+        return True
+
+    def run(self, bbid):
+        build = self.builds[bbid]
+        builddir = self.builddir(bbid)
+        outdir = os.path.join(builddir, 'artifacts')
+        os.makedirs(outdir, exist_ok=True)
+
+        returncode = None
+        if not build['cancelled']:
+            build['status'] = 'in_progress'
+            build['started_at'] = time.time()
+            self.save(build)
+
+            env = dict(os.environ, ARTIFACTS=outdir)
+            env.update({k: str(build[k]) for k in ['BUILDNUMBER', 'PACKAGE', 'MAINTAINER', 'COMMIT', 'REFERENCE', 'DEFAULT_TOKENS']})
+
+            logging.info('build %d: running %s' % (bbid, ' '.join(self.command)))
+            with open(os.path.join(builddir, 'log.txt'), 'wb') as log:
+                try:
+                    p = subprocess.Popen(self.command, env=env, stdout=log, stderr=subprocess.STDOUT)
+                except OSError as e:
+                    log.write(('%s\n' % e).encode())
+                else:
+                    with self.lock:
+                        self.procs[bbid] = p
+                    returncode = p.wait()
+                    with self.lock:
+                        del self.procs[bbid]
+
+        # upload the artifacts
+        for name in os.listdir(outdir):
+            shutil.make_archive(os.path.join(builddir, name), 'zip', os.path.join(outdir, name))
+        shutil.rmtree(outdir)
+
+        if build['cancelled']:
+            build['conclusion'] = 'cancelled'
+        elif returncode == 0:
+            build['conclusion'] = 'success'
+        else:
+            build['conclusion'] = 'failure'
+        build['status'] = 'completed'
+        self.save(build)
+        logging.info('build %d: %s' % (bbid, build['conclusion']))
+
+        # report completion
+        try:
+            carpetbag.update_status(process_run(build))
+        except Exception as e:
+            logging.error('build %d: reporting completion failed: %s' % (bbid, e))
+
+    def artifacts(self, bbid):
+        builddir = self.builddir(bbid)
+        names = sorted(fn[:-len('.zip')] for fn in os.listdir(builddir) if fn.endswith('.zip'))
+        return [{'name': n, 'archive_download_url': '%s/builds/%d/artifacts/%s.zip' % (self.url, bbid, urllib.parse.quote(n))}
+                for n in names]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug('local: ' + format % args)
+
+    def _reply(self, status, body=None, content_type='application/json'):
+        if body is None:
+            data = b''
+        elif isinstance(body, bytes):
+            data = body
+        else:
+            data = json.dumps(body).encode()
+
+        self.send_response(status)
+        if data:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _build(self, bbid):
+        with self.server.lock:
+            build = self.server.builds.get(int(bbid))
+            return dict(build) if build else None
+
+    def _file(self, fn, content_type):
+        try:
+            with open(fn, 'rb') as f:
+                return self._reply(200, f.read(), content_type=content_type)
+        except FileNotFoundError:
+            return self._reply(404, {'message': 'Not Found'})
+
+    def do_GET(self):
+        path = urllib.parse.unquote(urllib.parse.urlparse(self.path).path)
+
+        m = re.match(r'^/builds/(\d+)(/.*)?$', path)
+        build = self._build(m.group(1)) if m else None
+        if not build:
+            return self._reply(404, {'message': 'Not Found'})
+
+        builddir = self.server.builddir(build['id'])
+        rest = m.group(2) or ''
+
+        if rest == '':
+            return self._reply(200, build)
+        if rest == '/log':
+            return self._file(os.path.join(builddir, 'log.txt'), 'text/plain')
+        if rest == '/artifacts':
+            return self._reply(200, self.server.artifacts(build['id']) if build['status'] == 'completed' else [])
+
+        m = re.match(r'^/artifacts/([^/]+\.zip)$', rest)
+        if m:
+            return self._file(os.path.join(builddir, m.group(1)), 'application/zip')
+
+        self._reply(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode()) if length else {}
+        path = urllib.parse.urlparse(self.path).path
+
+        if path == '/builds':
+            return self._reply(201, self.server.dispatch(body))
+
+        m = re.match(r'^/builds/(\d+)/cancel$', path)
+        if m and self.server.cancel(int(m.group(1))):
+            return self._reply(202, {})
+
+        self._reply(404, {'message': 'Not Found'})
+
+
+#
+# a stub build command
+#
+
+def stub(args):
+    package = os.environ['PACKAGE']
+    outdir = os.environ['ARTIFACTS']
+
+    print('building %s %s' % (package, os.environ['COMMIT']))
+    time.sleep(random.uniform(0.5, 1.5) * args.duration)
+
+    def write(artifact, fn, content):
+        os.makedirs(os.path.dirname(os.path.join(outdir, artifact, fn)), exist_ok=True)
+        with open(os.path.join(outdir, artifact, fn), 'wb') as f:
+            f.write(content)
+
+    write('metadata', 'scallywag.json', json.dumps({
+        'BUILDNUMBER': int(os.environ['BUILDNUMBER']),
+        'PACKAGE': package,
+        'COMMIT': os.environ['COMMIT'],
+        'ARCH': 'source',
+        'MAINTAINER': os.environ['MAINTAINER'],
+        'REFERENCE': os.environ['REFERENCE'],
+        'TOKENS': os.environ['DEFAULT_TOKENS'],
+        'ANNOUNCE': '',
+    }).encode())
+
+    if random.random() < args.failure_rate:
+        print('build failed')
+        sys.exit(1)
+
+    for arch in ['source'] + args.arches.split():
+        suffix = '-src' if arch == 'source' else ''
+        write('%s packages' % arch, '%s/%s-1.0-1%s.tar.xz' % (package, package, suffix), random.randbytes(args.size))
+        write('%s packages' % arch, '%s/%s-1.0-1%s.hint' % (package, package, suffix), ('sdesc: "%s"\n' % package).encode())
+        print('built %s for %s' % (package, arch))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='local build backend')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('serve', help='run the build server')
+    p.add_argument('--port', type=int, default=int(urllib.parse.urlparse(api_url).port or 8010),
+                   help='port to listen on (default: from SCALLYWAG_LOCAL_URL)')
+    p.add_argument('--workers', type=int, default=4, help='builds run at once (default: 4)')
+    p.add_argument('--build-command', default='%s %s stub' % (sys.executable, os.path.realpath(__file__)),
+                   help='build command (default: the stub)')
+
+    p = subparsers.add_parser('stub', help='fabricate build artifacts (as a build command)')
+    p.add_argument('--duration', type=float, default=5.0, help='mean build duration (seconds)')
+    p.add_argument('--failure-rate', type=float, default=0.0, help='fraction of builds which fail')
+    p.add_argument('--arches', default='x86_64', help="arches built, besides 'source' (default: x86_64)")
+    p.add_argument('--size', type=int, default=64 * 1024, help='size of package files (bytes)')
+
+    args = parser.parse_args()
+
+    if args.command == 'stub':
+        stub(args)
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)-8s - %(message)s')
+
+    server = Server(('127.0.0.1', args.port), shlex.split(args.build_command), args.workers)
+    print('local build backend listening on %s' % server.url)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
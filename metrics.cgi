@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+#
+# export metrics in Prometheus text format
+#
+
+import sqlite3
+
+import carpetbag
+import durations
+import metrics
+
+
+def results():
+    lines = metrics.exposition()
+
+    conn = sqlite3.connect('file:%s?mode=ro' % carpetbag.dbfile, uri=True)
+    c = conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')
+    lines += metrics.gauge('scallywag_jobs', [({'status': status}, count) for (status, count) in c],
+                           help='Number of jobs in each status')
+
+    c = conn.execute("SELECT user, COUNT(*) FROM jobs WHERE status = 'queued' GROUP BY user")
+    lines += metrics.gauge('scallywag_queued_jobs', [({'user': user}, count) for (user, count) in c],
+                           help='Number of jobs waiting to be dispatched, per maintainer')
+
+    lines += metrics.gauge('scallywag_overdue_jobs', [({}, len(durations.overdue(conn)))],
+                           help='Number of running jobs taking much longer than usual for their package')
+    conn.close()
+
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == "__main__":
+    try:
+        lines = results()
+    except Exception:
+        # allow cgitb to do it's thing
+        #
+        # (cgitb is slow to import, so only when it's needed)
+        import cgitb
+        cgitb.enable()
+        raise
+    print('Content-Type: text/plain; version=0.0.4')
+    print()
+    print(lines, end='')
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+#
+# lightweight instrumentation: counters, histograms and timers
+#
+# Since most of our processes are short-lived (CGIs, hooks), values are
+# accumulated in-process and then added to the totals in metrics.db (when the
+# process exits, or when the daemon calls flush()).  metrics.cgi exports those
+# totals in Prometheus text format.
+#
+# Nothing is written if nothing was recorded, and nothing is computed unless
+# metrics.cgi is scraped.
+#
+
+import atexit
+import contextlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+basedir = os.path.dirname(os.path.realpath(__file__))
+dbfile = os.environ.get('SCALLYWAG_METRICS_DB', os.path.join(basedir, 'metrics.db'))
+
+default_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# (series name, labels) -> value, accumulated since the last flush
+_pending = {}
+# metric name -> (type, help)
+_types = {}
+_registered = False
+_lock = threading.Lock()
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"')) for k, v in sorted(labels.items()))
+
+
+def _add(series, labels, value):
+    global _registered
+    if not _registered:
+        atexit.register(flush)
+        _registered = True
+
+    key = (series, labels)
+    with _lock:
+        _pending[key] = _pending.get(key, 0) + value
+
+
+def inc(name, value=1, help='', **labels):
+    _types.setdefault(name, ('counter', help))
+    _add(name, _labels(labels), value)
+
+
+def observe(name, value, buckets=default_buckets, help='', **labels):
+    _types.setdefault(name, ('histogram', help))
+    for le in buckets:
+        _add(name + '_bucket', _labels(dict(labels, le=le)), 1 if value <= le else 0)
+    _add(name + '_bucket', _labels(dict(labels, le='+Inf')), 1)
+    _add(name + '_sum', _labels(labels), value)
+    _add(name + '_count', _labels(labels), 1)
+
+
+@contextlib.contextmanager
+def timer(name, buckets=default_buckets, help='', **labels):
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, buckets, help, **labels)
+
+
+def _create(conn):
+    conn.execute('CREATE TABLE IF NOT EXISTS samples (series TEXT, labels TEXT, value REAL NOT NULL, PRIMARY KEY (series, labels))')
+    conn.execute('CREATE TABLE IF NOT EXISTS types (name TEXT PRIMARY KEY, type TEXT, help TEXT)')
+
+
+def flush():
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+
+    if not pending:
+        return
+
+    try:
+        old_umask = os.umask(0o000)
+        try:
+            conn = sqlite3.connect(dbfile, timeout=5)
+        finally:
+            os.umask(old_umask)
+
+        with conn:
+            _create(conn)
+            conn.executemany('INSERT OR IGNORE INTO types (name, type, help) VALUES (?, ?, ?)',
+                             [(n, t, h) for n, (t, h) in _types.items()])
+            conn.executemany('INSERT INTO samples (series, labels, value) VALUES (?, ?, ?) '
+                             'ON CONFLICT (series, labels) DO UPDATE SET value = value + excluded.value',
+                             [(s, l, v) for (s, l), v in pending.items()])
+        conn.close()
+    except sqlite3.Error as e:
+        # never let instrumentation break what it's instrumenting
+        logging.warning('metrics: flush failed: %s' % e)
+
+
+def _format(value):
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+def gauge(name, values, help=''):
+    # render a gauge computed at scrape time, from a list of (labels, value)
+    lines = []
+    if help:
+        lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s gauge' % name)
+    for labels, value in values:
+        labels = _labels(labels)
+        lines.append('%s%s %s' % (name, '{%s}' % labels if labels else '', _format(value)))
+    return lines
+
+
+def exposition():
+    # render the accumulated totals in Prometheus text format
+    lines = []
+    if not os.path.exists(dbfile):
+        return lines
+
+    conn = sqlite3.connect('file:%s?mode=ro' % dbfile, uri=True)
+    types = {r[0]: (r[1], r[2]) for r in conn.execute('SELECT name, type, help FROM types')}
+    samples = conn.execute('SELECT series, labels, value FROM samples ORDER BY series, labels').fetchall()
+    conn.close()
+
+    for name in sorted(types):
+        (t, h) = types[name]
+        if h:
+            lines.append('# HELP %s %s' % (name, h))
+        lines.append('# TYPE %s %s' % (name, t))
+
+        for (series, labels, value) in samples:
+            if series == name or (t == 'histogram' and series in [name + '_bucket', name + '_sum', name + '_count']):
+                lines.append('%s%s %s' % (series, '{%s}' % labels if labels else '', _format(value)))
+
+    return lines
@@ -3,6 +3,7 @@
 import sqlite3
 
 import carpetbag
+import durations
 
 if __name__ == '__main__':
     with sqlite3.connect(carpetbag.dbfile) as conn:
@@ -31,6 +32,69 @@ if __name__ == '__main__':
         if 'announce' not in cols:
             cursor.execute("ALTER TABLE jobs ADD COLUMN announce TEXT NOT NULL DEFAULT ''")
 
+        if 'effective_tokens' not in cols:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN effective_tokens TEXT NOT NULL DEFAULT ''")
+
+        if 'metadata_tokens' not in cols:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN metadata_tokens TEXT")
+
+        if 'cached_from' not in cols:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN cached_from INTEGER")
+
+        if 'priority' not in cols:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+
+        if 'attempts' not in cols:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+
+        if 'next_attempt_at' not in cols:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+
+        if 'worker_id' not in cols:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN worker_id TEXT")
+
+        if 'lease_expires' not in cols:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN lease_expires REAL NOT NULL DEFAULT 0")
+
+        # the tokens the build is requested with (the maintainer's default
+        # tokens, plus those pushed with)
+        if 'default_tokens' not in cols:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN default_tokens TEXT")
+
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_srcpkg_hash ON jobs (srcpkg, hash)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_timestamp ON jobs (timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_next_attempt_at ON jobs (status, next_attempt_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_worker_id ON jobs (worker_id) WHERE worker_id IS NOT NULL")
+
+        # record the time of every status transition
+        conn.execute('''CREATE TABLE IF NOT EXISTS transitions
+        (job_id INTEGER NOT NULL, status TEXT NOT NULL, timestamp REAL NOT NULL)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS transitions_job_id ON transitions (job_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS transitions_timestamp ON transitions (timestamp)")
+
+        # the progress of fetching each arch of a job (see fetch.fetch())
+        conn.execute('''CREATE TABLE IF NOT EXISTS fetches
+        (job_id INTEGER NOT NULL, arch TEXT NOT NULL, state TEXT NOT NULL, timestamp REAL NOT NULL, PRIMARY KEY (job_id, arch))''')
+
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS jobs_insert_transition AFTER INSERT ON jobs
+        BEGIN
+          INSERT INTO transitions (job_id, status, timestamp) VALUES (NEW.id, NEW.status, (julianday('now') - 2440587.5) * 86400.0);
+        END''')
+
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS jobs_update_transition AFTER UPDATE OF status ON jobs
+        WHEN NEW.status IS NOT OLD.status
+        BEGIN
+          INSERT INTO transitions (job_id, status, timestamp) VALUES (NEW.id, NEW.status, (julianday('now') - 2440587.5) * 86400.0);
+        END''')
+
+        # the model of build durations (see durations.py), built from the
+        # history the first time
+        conn.execute('''CREATE TABLE IF NOT EXISTS durations
+        (package TEXT PRIMARY KEY, samples TEXT NOT NULL, count INTEGER NOT NULL, median REAL NOT NULL, p90 REAL NOT NULL, updated REAL NOT NULL)''')
+        if not conn.execute('SELECT 1 FROM durations LIMIT 1').fetchone():
+            durations.rebuild(conn)
+
         print(cols)
 
         conn.execute("UPDATE jobs SET status = ? WHERE status = ?", ('build succeeded', 'succeeded'))
@@ -1,20 +1,40 @@
 #!/usr/bin/env python3
 #
 # periodically check the completion status of jobs, in case we missed a
-# notification
+# notification, and give up on jobs which were never dispatched
 #
-# XXX: also move stuff on from 'requested' status?
-# XXX:
 
 import sqlite3
 import logging
+import time
 
 import backends
 import carpetbag
+import metrics
+
+# how long a job can be 'requested' before it's given up on
+#
+# (dispatching takes seconds, so a job which has been 'requested' this long was
+# being dispatched by a process which died, and would otherwise take up one of
+# the scheduler's running slots for good)
+requested_timeout = 60 * 60
+
+
+def reclaim_requested(conn):
+    c = conn.execute("SELECT j.id FROM jobs j WHERE j.status = 'requested' AND "
+                     "(SELECT MAX(t.timestamp) FROM transitions t WHERE t.job_id = j.id AND t.status = 'requested') < ?",
+                     (time.time() - requested_timeout,))
+    for (jobid,) in c.fetchall():
+        if carpetbag.transition(conn, jobid, 'dispatch failed', expected='requested'):
+            logging.warning('job %d: requested but never dispatched, giving up' % jobid)
+            metrics.inc('scallywag_reclaimed_total', help="Jobs which were left 'requested'")
 
 
 def process():
     with sqlite3.connect(carpetbag.dbfile) as conn:
+        reclaim_requested(conn)
+        conn.commit()
+
         c = conn.execute("SELECT id, backend, backend_id FROM jobs WHERE status = 'pending'")
 
         rows = c.fetchall()
@@ -32,4 +52,5 @@ def process():
             if backend:
                 u = backend.check_build_status(backend_id)
                 if u:
+                    metrics.inc('scallywag_reconciled_total', status=u.status, help='Job statuses checked by reconcile')
                     carpetbag.update_status(u)
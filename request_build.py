@@ -3,6 +3,7 @@
 # start or cancel a package build via backend API
 #
 
+import concurrent.futures
 import logging
 import logging.handlers
 import os
@@ -11,6 +12,15 @@ import time
 
 import backends
 import carpetbag
+import metrics
+import scheduler
+import utils
+
+
+# the backend builds are requested from, unless the tokens say otherwise
+#
+# (SCALLYWAG_BACKEND=local runs builds on this machine, see local.py)
+default_backend = os.environ.get('SCALLYWAG_BACKEND', 'github')
 
 
 # subclass TimedRotatingFileHandler with open umask
@@ -22,18 +32,30 @@ class SharedTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
         return rtv
 
 
-rfh = SharedTimedRotatingFileHandler('/sourceware/cygwin-staging/logs/build-request.log', backupCount=48, when='midnight')
-rfh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)-8s - %(message)s'))
-rfh.setLevel(logging.DEBUG)
+rfh = None
+
+
+# set up logging to build-request.log
+#
+# (deferred until there's something to log, so that importing this is cheap.
+# Only for the CLI and post-receive, scallywagd has its own log)
+def logging_setup():
+    global rfh
+    if rfh:
+        return
+
+    rfh = SharedTimedRotatingFileHandler(os.path.join(carpetbag.stagingroot, 'logs', 'build-request.log'), backupCount=48, when='midnight')
+    rfh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)-8s - %(message)s'))
+    rfh.setLevel(logging.DEBUG)
 
-logging.getLogger().addHandler(rfh)
-logging.getLogger().setLevel(logging.NOTSET)
+    logging.getLogger().addHandler(rfh)
+    logging.getLogger().setLevel(logging.NOTSET)
 
 
-def request_build(commit, reference, package, maintainer, tokens=''):
+def request_build(commit, reference, package, maintainer, tokens='', priority=scheduler.INTERACTIVE, dispatch=True):
     default_tokens = ''
     try:
-        with open(os.path.join('/sourceware/cygwin-staging/home', maintainer, '!scallywag')) as f:
+        with open(os.path.join(carpetbag.stagingroot, 'home', maintainer, '!scallywag')) as f:
             default_tokens = ''.join([l.strip() for l in f.readlines()])
     except FileNotFoundError:
         pass
@@ -49,41 +71,217 @@ def request_build(commit, reference, package, maintainer, tokens=''):
         print('scallywag: not building due to nobuild')
         return
 
-    # record job as requested and generate buildnumber
+    logging_setup()
+
+    # if this commit has already been successfully built with the same
+    # tokens, reuse the results of that build, rather than building it again
+    # (unless 'rebuild' token is present)
+    if 'rebuild' not in default_tokens.split():
+        buildnumber = request_cached_build(commit, reference, package, maintainer, tokens, default_tokens)
+        if buildnumber:
+            if 'nosupersede' not in default_tokens.split():
+                supersede(package, reference, buildnumber)
+            return buildnumber
+
+    # select backend
+    if 'appveyor' in default_tokens:
+        backend_name = 'appveyor'
+    else:
+        backend_name = default_backend
+
+    # record job as queued and generate buildnumber
     now = time.time()
     with sqlite3.connect(carpetbag.dbfile) as conn:
-        cursor = conn.execute('INSERT INTO jobs (srcpkg, hash, ref, user, status, timestamp, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                              (package, commit, reference, maintainer, 'requested', now, tokens))
+        cursor = conn.execute('INSERT INTO jobs (srcpkg, hash, ref, user, status, timestamp, tokens, default_tokens, effective_tokens, backend, priority) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (package, commit, reference, maintainer, 'queued', now, tokens, default_tokens.strip(), carpetbag.effective_tokens(default_tokens),
+                               backend_name, priority))
         buildnumber = cursor.lastrowid
         conn.commit()
     conn.close()
 
-    # select backend
-    if 'appveyor' in default_tokens:
-        backend_name = 'appveyor'
-    else:
-        backend_name = 'github'
+    # earlier builds of the same package and ref which haven't completed yet
+    # are no longer interesting (unless 'nosupersede' token is present)
+    if 'nosupersede' not in default_tokens.split():
+        supersede(package, reference, buildnumber)
+
+    # leave dispatching to the caller, if it's requesting a batch of builds
+    if not dispatch:
+        return buildnumber
+
+    # dispatch this job now, if the scheduler allows it
+    schedule(buildnumber)
+
+    with sqlite3.connect(carpetbag.dbfile) as conn:
+        (status,) = conn.execute('SELECT status FROM jobs WHERE id = ?', (buildnumber,)).fetchone()
+        if status == 'queued':
+            position = scheduler.positions(conn).get(buildnumber, 0)
+            print('scallywag: build {0} waiting to be dispatched, position {1} in queue'.format(buildnumber, position))
+            print('scallywag: https://cygwin.com/cgi-bin2/jobs.cgi?id={0}'.format(buildnumber))
+    conn.close()
+
+
+# the most jobs dispatched to backends at once
+dispatch_concurrency = 4
+
+
+# dispatch queued jobs, as permitted by the scheduler (or only the specified
+# job, if it's permitted)
+def schedule(jobid=None):
+    claimed = []
+    with utils.locked('/tmp/scallywag.schedule.lock'):
+        with sqlite3.connect(carpetbag.dbfile) as conn:
+            selected = scheduler.dispatchable(conn)
+            if jobid is not None:
+                selected = [j for j in selected if j == jobid]
+
+            for j in selected:
+                if carpetbag.transition(conn, j, 'requested'):
+                    claimed.append(j)
+            conn.commit()
+        conn.close()
+
+    if len(claimed) <= 1:
+        for j in claimed:
+            dispatch(j)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=dispatch_concurrency) as executor:
+        list(executor.map(dispatch, claimed))
+
+
+def dispatch(buildnumber):
+    with sqlite3.connect(carpetbag.dbfile) as conn:
+        # (jobs queued before default_tokens was recorded only have
+        # effective_tokens)
+        (package, commit, reference, maintainer, default_tokens, backend_name, timestamp) = conn.execute('SELECT srcpkg, hash, ref, user, COALESCE(default_tokens, effective_tokens), '
+                                                                                                         'backend, timestamp FROM jobs WHERE id = ?',
+                                                                                                         (buildnumber,)).fetchone()
+    conn.close()
+
+    logging.info('dispatching build %d to %s' % (buildnumber, backend_name))
 
     # request job
+    bbid = -1
     backend = backends.lookup_by_name(backend_name)
+
+    # if the backend's API is rate limited, put the job back in the queue, to
+    # try again later
+    if backend and not backend.throttle():
+        print('scallywag: build {0} deferred, {1} is rate limiting requests'.format(buildnumber, backend_name))
+        with sqlite3.connect(carpetbag.dbfile) as conn:
+            carpetbag.transition(conn, buildnumber, 'queued')
+        conn.close()
+        return
+
+    # (an exception, e.g. failing to get a token to make the request with, is
+    # an error requesting the job, rather than leaving it 'requested')
     if backend:
-        bbid, buildurl = backend.request_build(package, maintainer, commit, reference, default_tokens, buildnumber)
+        try:
+            with metrics.timer('scallywag_dispatch_seconds', backend=backend_name, help='Time taken to dispatch a job to the backend'):
+                bbid, buildurl = backend.request_build(package, maintainer, commit, reference, default_tokens, buildnumber)
+        except Exception as e:
+            logging.error('dispatching build %d to %s failed: %s' % (buildnumber, backend_name, e))
+            bbid = -1
+
+    metrics.observe('scallywag_dispatch_latency_seconds', time.time() - timestamp, backend=backend_name,
+                    help='Time from build request until dispatched to the backend')
 
     # an error occurred requesting the job
     if bbid < 0:
         print('scallywag: error queuing build {0} on {1}'.format(buildnumber, backend_name))
+        with sqlite3.connect(carpetbag.dbfile) as conn:
+            carpetbag.transition(conn, buildnumber, 'dispatch failed')
+        conn.close()
         return
 
     print('scallywag: build {0} queued on {1}'.format(buildnumber, backend_name))
     print('scallywag: https://cygwin.com/cgi-bin2/jobs.cgi?id={0}'.format(buildnumber))
 
     # record job as pending
+    #
+    # (unless it was superseded by a later build or cancelled while we were
+    # waiting for the backend, in which case cancel it)
     with sqlite3.connect(carpetbag.dbfile) as conn:
-        conn.execute('UPDATE jobs SET status = ?, logurl = ?, backend = ?, backend_id = ? WHERE id = ?',
-                     ('pending', buildurl, backend_name, bbid, buildnumber))
+        if not carpetbag.transition(conn, buildnumber, 'pending', {'logurl': buildurl, 'backend_id': bbid}):
+            conn.execute('UPDATE jobs SET logurl = ?, backend_id = ? WHERE id = ?',
+                         (buildurl, bbid, buildnumber))
+        (status,) = conn.execute('SELECT status FROM jobs WHERE id = ?', (buildnumber,)).fetchone()
         conn.commit()
     conn.close()
 
+    if status in ['superseded', 'cancelled'] and bbid:
+        print('scallywag: build {0} was {1}, cancelling'.format(buildnumber, status))
+        backend.cancel_build(bbid)
+
+
+def request_cached_build(commit, reference, package, maintainer, tokens, default_tokens):
+    now = time.time()
+    with sqlite3.connect(carpetbag.dbfile) as conn:
+        cached = carpetbag.lookup_cached_build(conn, package, commit, default_tokens)
+        if cached:
+            # link to the original build, rather than to another cache hit
+            (cached_id, arches, artifacts, announce, metadata_tokens, cached_tokens, backend_name, bbid, buildurl, duration, cached_from) = cached
+            if cached_from:
+                cached_id = cached_from
+
+            # tokens which don't affect the build (e.g. 'deploy') may differ
+            # from those of the cached build, so use those of this request
+            metadata_tokens = carpetbag.rebase_tokens(metadata_tokens, cached_tokens, default_tokens)
+
+            cursor = conn.execute('INSERT INTO jobs (srcpkg, hash, ref, user, status, timestamp, tokens, default_tokens, effective_tokens, '
+                                  'arches, artifacts, announce, metadata_tokens, backend, backend_id, logurl, duration, cached_from) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  (package, commit, reference, maintainer, 'build succeeded', now, tokens, default_tokens.strip(),
+                                   carpetbag.effective_tokens(default_tokens),
+                                   arches, artifacts, announce, metadata_tokens, backend_name, bbid, buildurl, duration, cached_id))
+            buildnumber = cursor.lastrowid
+            conn.commit()
+    conn.close()
+
+    if not cached:
+        return None
+
+    logging.info('build %d is a cache hit on build %d' % (buildnumber, cached_id))
+    print('scallywag: build {0} reuses the result of identical build {1}'.format(buildnumber, cached_id))
+    print('scallywag: https://cygwin.com/cgi-bin2/jobs.cgi?id={0}'.format(buildnumber))
+
+    # deploy from the artifacts of the previous build, if this job is
+    # deployable
+    u = carpetbag.Update()
+    u.buildnumber = buildnumber
+    u.package = package
+    u.reference = reference
+    u.status = 'build succeeded'
+    u.tokens = metadata_tokens
+    if carpetbag.deploy(u):
+        print('scallywag: build {0} will be deployed'.format(buildnumber))
+
+    return buildnumber
+
+
+def supersede(package, reference, buildnumber):
+    superseded = []
+    with sqlite3.connect(carpetbag.dbfile) as conn:
+        cursor = conn.execute("SELECT id, status, backend, backend_id FROM jobs WHERE srcpkg = ? AND ref = ? AND id < ? AND status IN ('queued', 'requested', 'pending')",
+                              (package, reference, buildnumber))
+        for (jobid, status, backend_name, bbid) in cursor.fetchall():
+            # only if the status hasn't changed since we looked
+            if carpetbag.transition(conn, jobid, 'superseded', expected=status):
+                superseded.append((jobid, backend_name, bbid))
+        conn.commit()
+    conn.close()
+
+    for (jobid, backend_name, bbid) in superseded:
+        logging.info('build %d superseded by build %d' % (jobid, buildnumber))
+        print('scallywag: build {0} superseded by build {1}'.format(jobid, buildnumber))
+
+        # a job in 'queued' status hasn't been dispatched, and a job in
+        # 'requested' status doesn't have a backend id yet, it will be
+        # cancelled by the process dispatching it, once it gets one
+        if backend_name and bbid:
+            cancel_build(backend_name, bbid)
+
 
 def cancel_build(backend, bbid):
     backend = backends.lookup_by_name(backend)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# decide which queued jobs to dispatch to the backend next
+#
+# Jobs wait in 'queued' status until dispatching them wouldn't exceed the
+# global limit on the number of running jobs, or the per-maintainer limit.
+#
+# The order queued jobs are dispatched in is by priority (so interactive
+# pushes go before bulk reruns), then by fair share (the maintainer with the
+# fewest jobs running or already ahead in the queue goes next), then shortest
+# expected duration first (according to the history of the package, see
+# durations.py).
+#
+
+import durations
+
+# priorities
+INTERACTIVE = 0
+BULK = 1
+
+# concurrency limits
+max_running = 10
+max_running_per_maintainer = 4
+
+# statuses of a job which has been dispatched, but not yet completed
+running_statuses = ['requested', 'pending']
+
+
+def expected_duration(conn, package, cache):
+    (median, _) = durations.estimate(conn, package, cache)
+    return median
+
+
+def running(conn):
+    c = conn.execute("SELECT user, COUNT(*) FROM jobs WHERE status IN (%s) GROUP BY user" % ', '.join('?' * len(running_statuses)),
+                     tuple(running_statuses))
+    return {r[0]: r[1] for r in c}
+
+
+def queue_order(conn):
+    # returns a list of (id, user) for the queued jobs, in the order they
+    # should be dispatched
+    c = conn.execute("SELECT id, srcpkg, user, priority FROM jobs WHERE status = 'queued'")
+
+    cache = {}
+    queues = {}
+    for (jobid, package, user, priority) in c.fetchall():
+        queues.setdefault(user, []).append((priority, expected_duration(conn, package, cache), jobid))
+
+    for q in queues.values():
+        q.sort(reverse=True)
+
+    share = running(conn)
+
+    order = []
+    while queues:
+        # pick the maintainer whose next job should go first
+        user = min(queues, key=lambda u: (queues[u][-1][0], share.get(u, 0), queues[u][-1][1], queues[u][-1][2]))
+        (_, _, jobid) = queues[user].pop()
+        if not queues[user]:
+            del queues[user]
+
+        order.append((jobid, user))
+        share[user] = share.get(user, 0) + 1
+
+    return order
+
+
+def dispatchable(conn):
+    # returns a list of the ids of queued jobs which can be dispatched now
+    share = running(conn)
+    total = sum(share.values())
+
+    selected = []
+    for (jobid, user) in queue_order(conn):
+        if total >= max_running:
+            break
+
+        if share.get(user, 0) >= max_running_per_maintainer:
+            continue
+
+        selected.append(jobid)
+        share[user] = share.get(user, 0) + 1
+        total += 1
+
+    return selected
+
+
+def positions(conn):
+    # returns a dict mapping the id of queued jobs to their (1-based) position
+    # in the queue
+    return {jobid: i + 1 for i, (jobid, _) in enumerate(queue_order(conn))}
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+#
+# an index of the packages in the mirror's setup.ini, for checking build
+# dependencies before a build is requested
+#
+# The package names, what each requires, and which names are obsoleted by
+# which packages, are kept in a small sqlite database, rebuilt only when
+# setup.ini changes (scallywagd keeps it up to date, if SCALLYWAG_SETUP_INI is
+# set), so looking up a handful of names (e.g. in post-receive) costs a few
+# queries, rather than parsing a multi-megabyte file.
+#
+# The build runner indexes the setup.ini of the mirror it installs from (see
+# download()), so the build dependencies it installs are checked the same way.
+#
+# e.g. setupini.py update /var/ftp/pub/cygwin/x86_64/setup.ini
+#      setupini.py check gcc-core make libfoo-devel
+#
+
+import argparse
+import contextlib
+import logging
+import os
+import re
+import sqlite3
+import sys
+
+basedir = os.path.dirname(os.path.realpath(__file__))
+dbfile = os.environ.get('SCALLYWAG_SETUPINI_DB', os.path.join(basedir, 'setupini.db'))
+
+# the setup.ini to index
+setup_ini = os.environ.get('SCALLYWAG_SETUP_INI')
+
+
+def _names(value):
+    # a list of package names, with any version constraints removed
+    # (e.g. 'requires: a b', 'depends2: a, b (>= 1.0)')
+    value = re.sub(r'\([^)]*\)', '', value)
+    return [n for n in re.split(r'[,\s]+', value) if n]
+
+
+def parse(f):
+    # parse setup.ini from the text stream f.  Returns a dict of package name
+    # to a dict of the fields of interest (of the current version)
+    packages = {}
+    package = None
+    section = None
+
+    lines = iter(f)
+    for l in lines:
+        l = l.rstrip('\n')
+
+        if l.startswith('@ '):
+            package = packages.setdefault(l[2:].strip(), {'requires': set(), 'obsoletes': set(), 'provides': set()})
+            section = None
+            continue
+
+        if l.startswith('['):
+            section = l.strip('[] ')
+            continue
+
+        match = re.match(r'^([\w-]+):\s*(.*)$', l)
+        if not match:
+            continue
+        (key, value) = match.groups()
+
+        # skip over the rest of a multi-line quoted value
+        if value.startswith('"') and (len(value) == 1 or not value.endswith('"')):
+            for l in lines:
+                if l.rstrip('\n').endswith('"'):
+                    break
+            continue
+
+        # only the current version is of interest
+        if package is None or section:
+            continue
+
+        if key in ['requires', 'depends2']:
+            package['requires'].update(_names(value))
+        elif key in ['obsoletes', 'provides']:
+            package[key].update(_names(value))
+
+    return packages
+
+
+def update(fn, force=False):
+    # (re)build the index from setup.ini fn, if it's changed since the index
+    # was built.  Returns True if it was rebuilt.
+    mtime = str(os.path.getmtime(fn))
+    if not force and os.path.exists(dbfile):
+        # (an index which can't be read, e.g. one left incomplete by an older
+        # version, is rebuilt)
+        try:
+            with contextlib.closing(sqlite3.connect(dbfile)) as conn:
+                row = conn.execute("SELECT value FROM info WHERE key = 'mtime'").fetchone()
+        except sqlite3.Error as e:
+            logging.warning('index %s is unreadable, rebuilding: %s' % (dbfile, e))
+            row = None
+        if row and row[0] == mtime:
+            return False
+
+    with open(fn, errors='replace') as f:
+        packages = parse(f)
+
+    # build the new index alongside, then replace the old one, so readers
+    # always see a complete index
+    tmpfile = dbfile + '.tmp'
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmpfile)
+
+    conn = sqlite3.connect(tmpfile)
+    with conn:
+        conn.execute('CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE packages (name TEXT PRIMARY KEY) WITHOUT ROWID')
+        # (including from a name provided by a package to that package)
+        conn.execute('CREATE TABLE requires (package TEXT, require TEXT, PRIMARY KEY (package, require)) WITHOUT ROWID')
+        conn.execute('CREATE TABLE obsoletes (name TEXT PRIMARY KEY, by TEXT) WITHOUT ROWID')
+        conn.execute('CREATE TABLE provides (name TEXT PRIMARY KEY, by TEXT) WITHOUT ROWID')
+
+        conn.execute("INSERT INTO info (key, value) VALUES ('mtime', ?)", (mtime,))
+        for name, p in packages.items():
+            conn.execute('INSERT OR IGNORE INTO packages (name) VALUES (?)', (name,))
+            conn.executemany('INSERT OR IGNORE INTO requires (package, require) VALUES (?, ?)',
+                             [(name, r) for r in p['requires'] if r != name])
+            for provided in p['provides']:
+                conn.execute('INSERT OR IGNORE INTO requires (package, require) VALUES (?, ?)', (provided, name))
+                conn.execute('INSERT OR IGNORE INTO provides (name, by) VALUES (?, ?)', (provided, name))
+            conn.executemany('INSERT OR IGNORE INTO obsoletes (name, by) VALUES (?, ?)',
+                             [(o, name) for o in p['obsoletes']])
+    conn.execute('VACUUM')
+    conn.close()
+
+    os.replace(tmpfile, dbfile)
+    logging.info('indexed %d packages from %s' % (len(packages), fn))
+    return True
+
+
+def download(mirror, arch, fn):
+    # fetch the setup.ini for arch from mirror to fn (e.g. on the build runner,
+    # which has no index of its own)
+    #
+    # (imported here, as they're only needed there)
+    import lzma
+    import urllib.request
+
+    url = '%s/%s/setup.xz' % (mirror.rstrip('/'), arch)
+    logging.info('fetching %s' % url)
+    with urllib.request.urlopen(url, timeout=60) as response:
+        content = lzma.decompress(response.read())
+
+    with open(fn, 'wb') as f:
+        f.write(content)
+    return fn
+
+
+def connect():
+    # a read-only connection to the index, or None if there isn't one
+    if not os.path.exists(dbfile):
+        return None
+    return sqlite3.connect('file:%s?mode=ro' % dbfile, uri=True)
+
+
+def _closure(conn, name):
+    # everything which installing name installs (other than name itself)
+    c = conn.execute('WITH RECURSIVE closure(name) AS '
+                     '(SELECT require FROM requires WHERE package = ? '
+                     'UNION SELECT r.require FROM requires r JOIN closure c ON r.package = c.name) '
+                     'SELECT name FROM closure', (name,))
+    return {r[0] for r in c} - {name}
+
+
+def validate(conn, names):
+    # returns the names, with obsolete names replaced by the package which
+    # obsoletes them (and names which are only provided by a package by that
+    # package), and the set of names which aren't known at all
+    result = set()
+    unknown = set()
+    for name in names:
+        row = conn.execute('SELECT by FROM obsoletes WHERE name = ?', (name,)).fetchone()
+        if row:
+            logging.info('%s is obsoleted by %s' % (name, row[0]))
+            name = row[0]
+
+        if not conn.execute('SELECT 1 FROM packages WHERE name = ?', (name,)).fetchone():
+            row = conn.execute('SELECT by FROM provides WHERE name = ?', (name,)).fetchone()
+            if row:
+                logging.info('%s is provided by %s' % (name, row[0]))
+                name = row[0]
+            else:
+                unknown.add(name)
+        result.add(name)
+
+    return result, unknown
+
+
+def minimal(conn, names):
+    # returns the names, less those which will be installed anyway as a
+    # requirement of one of the others
+    closures = {n: _closure(conn, n) for n in names}
+
+    result = set(names)
+    for name in sorted(names):
+        if any(name in closures[other] for other in result if other != name):
+            result.discard(name)
+
+    return result
+
+
+def check(conn, names):
+    # validate and minimize names.  Returns the install set and the set of
+    # unknown names.
+    names, unknown = validate(conn, names)
+    return minimal(conn, names - unknown) | unknown, unknown
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+    logging.basicConfig(format=os.path.basename(sys.argv[0]) + ': %(message)s')
+
+    parser = argparse.ArgumentParser(description='index setup.ini, and check package names against it')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_update = subparsers.add_parser('update', help='(re)build the index')
+    parser_update.add_argument('setupini', metavar='SETUP_INI', nargs='?', default=setup_ini, help='path to setup.ini (default: $SCALLYWAG_SETUP_INI)')
+    parser_update.add_argument('--force', action='store_true', help='rebuild even if unchanged')
+    parser_check = subparsers.add_parser('check', help='check package names, and show the minimal install set')
+    parser_check.add_argument('names', metavar='PACKAGE', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'update':
+        if not args.setupini:
+            sys.exit('no setup.ini given')
+        update(args.setupini, args.force)
+    else:
+        conn = connect()
+        if not conn:
+            sys.exit('no index, run update first')
+
+        install, unknown = check(conn, args.names)
+        print('install: %s' % ' '.join(sorted(install)))
+        if unknown:
+            sys.exit('unknown: %s' % ' '.join(sorted(unknown)))
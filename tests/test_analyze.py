@@ -0,0 +1,67 @@
+import json
+import os
+import re
+
+import pytest
+
+import analyze
+import setupini
+
+workflow = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), '.github', 'workflows', 'scallywag.yml')
+
+
+@pytest.fixture(autouse=True)
+def no_index(tmp_path, monkeypatch):
+    # don't check build dependencies against any index of setup.ini
+    monkeypatch.setattr(setupini, 'dbfile', str(tmp_path / 'setupini.db'))
+
+
+def outputs(tmp_path, cygport, default_tokens=()):
+    files = {'foo.cygport': cygport.encode()}
+    package = analyze._analyze(list(files), files.get, list(default_tokens), static=True)
+    assert package.kind == 'cygport'
+
+    fn = tmp_path / 'github_output'
+    fn.write_text('other=1\n')
+    analyze.write_outputs(str(fn), package)
+
+    lines = fn.read_text().splitlines()
+    assert lines[0] == 'other=1'
+    return dict(l.split('=', 1) for l in lines[1:])
+
+
+def jobs_run(outputs):
+    # the arch jobs in scallywag.yml which run, given the outputs of the source
+    # job, evaluating their conditions (which are all of the form
+    # "nobuild != 'true' && contains(fromJSON(arches), ARCH)")
+    with open(workflow) as f:
+        content = f.read()
+
+    conditions = re.findall(r"^\s+if: \$\{\{ needs\.source\.outputs\.nobuild != 'true' && "
+                            r"contains\(fromJSON\(needs\.source\.outputs\.arches\), '(\w+)'\) \}\}$", content, re.MULTILINE)
+    assert sorted(conditions) == ['noarch', 'x86_64']
+
+    return {arch for arch in conditions if outputs['nobuild'] != 'true' and arch in json.loads(outputs['arches'])}
+
+
+@pytest.mark.parametrize('cygport, expected', [
+    ('NAME=foo\n', {'x86_64'}),
+    ('NAME=foo\nARCH=all\n', {'x86_64'}),
+    ('NAME=foo\nARCH=noarch\n', {'noarch'}),
+    ('NAME=foo\nARCH="x86_64 noarch"\n', {'x86_64', 'noarch'}),
+    ('NAME=foo\ninherit cross\nCROSS_HOST=x86_64-w64-mingw32\n', {'noarch'}),
+])
+def test_arches(tmp_path, cygport, expected):
+    o = outputs(tmp_path, cygport)
+    assert o['nobuild'] == 'false'
+    assert jobs_run(o) == expected
+
+
+def test_nobuild(tmp_path):
+    o = outputs(tmp_path, 'NAME=foo\nARCH="x86_64 noarch"\nSCALLYWAG="nobuild"\n')
+    assert o['nobuild'] == 'true'
+    assert jobs_run(o) == set()
+
+    o = outputs(tmp_path, 'NAME=foo\n', default_tokens=['nobuild'])
+    assert o['nobuild'] == 'true'
+    assert jobs_run(o) == set()
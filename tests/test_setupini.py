@@ -0,0 +1,85 @@
+import lzma
+import os
+import sqlite3
+
+import pytest
+
+import setupini
+
+fixture = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'setup.ini')
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(setupini, 'dbfile', str(tmp_path / 'setupini.db'))
+    assert setupini.update(fixture)
+    conn = setupini.connect()
+    yield conn
+    conn.close()
+
+
+def test_parse():
+    with open(fixture) as f:
+        packages = setupini.parse(f)
+
+    assert len(packages) == 11
+    # version constraints are removed
+    assert packages['make']['requires'] == {'cygwin', 'libguile3.0_1', 'libintl8'}
+    # only the current version is of interest
+    assert packages['bash']['requires'] == {'cygwin', 'libreadline7'}
+    # the rest of a multi-line value is skipped
+    assert packages['cygwin']['requires'] == {'base-cygwin'}
+    assert packages['cygwin']['provides'] == {'cygwin-runtime'}
+    assert packages['python39-foo']['obsoletes'] == {'python3-foo', 'python-foo'}
+    assert packages['libfoo-devel']['provides'] == {'foo-devel'}
+
+
+def test_update(conn, tmp_path, monkeypatch):
+    # unchanged
+    assert not setupini.update(fixture)
+
+    # an index without an info table is rebuilt
+    broken = str(tmp_path / 'broken.db')
+    sqlite3.connect(broken).close()
+    monkeypatch.setattr(setupini, 'dbfile', broken)
+    assert setupini.update(fixture)
+    assert not setupini.update(fixture)
+
+
+def test_validate(conn):
+    names, unknown = setupini.validate(conn, ['python3-foo', 'foo-devel', 'cygwin-runtime', 'make', 'nonesuch'])
+    assert names == {'python39-foo', 'libfoo-devel', 'cygwin', 'make', 'nonesuch'}
+    assert unknown == {'nonesuch'}
+
+
+def test_minimal(conn):
+    assert setupini.minimal(conn, {'bash', 'cygwin', 'libreadline7', 'libncursesw10', 'make'}) == {'bash', 'make'}
+    assert setupini.minimal(conn, {'cygwin-devel', 'libintl8'}) == {'cygwin-devel', 'libintl8'}
+
+
+def test_minimal_cycle(conn):
+    # cygwin and base-cygwin require each other, so only one of them is needed
+    # (but not neither)
+    assert setupini.minimal(conn, {'cygwin', 'base-cygwin'}) == {'cygwin'}
+    assert setupini.minimal(conn, {'cygwin', 'base-cygwin', 'bash'}) == {'bash'}
+
+
+def test_check(conn):
+    install, unknown = setupini.check(conn, ['python3-foo', 'cygwin', 'bash', 'nonesuch'])
+    assert install == {'python39-foo', 'bash', 'nonesuch'}
+    assert unknown == {'nonesuch'}
+
+
+def test_download(tmp_path, monkeypatch):
+    # a mirror, as a file: URL
+    (tmp_path / 'x86_64').mkdir()
+    with open(fixture, 'rb') as f:
+        (tmp_path / 'x86_64' / 'setup.xz').write_bytes(lzma.compress(f.read()))
+
+    fn = setupini.download(tmp_path.as_uri() + '/', 'x86_64', str(tmp_path / 'setup.ini'))
+    monkeypatch.setattr(setupini, 'dbfile', str(tmp_path / 'setupini.db'))
+    assert setupini.update(fn)
+
+    conn = setupini.connect()
+    assert setupini.check(conn, ['python3-foo', 'cygwin', 'bash']) == ({'python39-foo', 'bash'}, set())
+    conn.close()
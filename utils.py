@@ -3,9 +3,14 @@
 # utility functions
 #
 
+import contextlib
+import datetime
+import fcntl
 import getpass
+import logging
 import os
 import pwd
+import time
 
 
 def get_maintainer():
@@ -22,3 +27,26 @@ def get_maintainer():
             maintainer = getpass.getuser()
 
     return maintainer
+
+
+@contextlib.contextmanager
+def locked(lockfn):
+    old_umask = os.umask(0o000)
+    lockfile = open(lockfn, 'w+')
+    os.umask(old_umask)
+    fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+    logging.info("acquired lock %s" % lockfn)
+    try:
+        yield lockfile
+    finally:
+        logging.info("releasing lock %s" % lockfn)
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+        lockfile.close()
+
+
+# parse a date given on the command line: either YYYY-MM-DD, or Nd for N days
+# ago
+def parse_date(s):
+    if s.endswith('d'):
+        return time.time() - int(s[:-1]) * 24 * 60 * 60
+    return datetime.datetime.strptime(s, '%Y-%m-%d').timestamp()